@@ -17,6 +17,7 @@ from serapis.config import update_config, config
 from serapis import util
 from serapis import preprocess
 import os
+import sys
 import time
 from tqdm import tqdm
 import math
@@ -72,12 +73,40 @@ def add_wordlist(filename, batch_size=0, interval=60):
     print("Added wordlist '{}'".format(key))
 
 
-def clean(filename):
+def read_wordlist(filename, counter):
+    """Yields the lines of a wordlist one by one and counts them in counter[0]."""
     with codecs.open(filename, 'r', 'utf-8') as f:
-        wordlist = f.read().splitlines()
-    cleaned = list(tqdm(preprocess.clean_and_qualify_wordlist(wordlist), total=len(wordlist) * .6, desc="Cleaning", unit="word"))
-    print "Retained {} out of {} words ({:.0%}).".format(len(cleaned), len(wordlist), 1. * len(cleaned) / len(wordlist))
-    print "\n".join(cleaned)
+        for line in f:
+            for word in line.splitlines():
+                counter[0] += 1
+                yield word
+
+
+def clean(filename, output=None, processes=1, chunksize=1000):
+    """
+    Cleans a wordlist and writes the words that qualify to output (or
+    stdout) as they come in. Reports statistics on stderr.
+
+    Args:
+        filename: str -- file with one term per line
+        output: str -- file to write cleaned words to
+        processes: int -- number of worker processes
+        chunksize: int -- words per chunk sent to a worker
+    """
+    start = time.time()
+    total, retained = [0], 0
+    out = codecs.open(output, 'w', 'utf-8') if output else codecs.getwriter('utf-8')(sys.stdout)
+    try:
+        words = preprocess.clean_and_qualify_wordlist(read_wordlist(filename, total), processes, chunksize)
+        for word in tqdm(words, desc="Cleaning", unit="word"):
+            out.write(word + "\n")
+            retained += 1
+    finally:
+        if output:
+            out.close()
+    duration = time.time() - start
+    sys.stderr.write("Retained {} out of {} words ({:.0%}), {:.0f} words/sec.\n".format(
+        retained, total[0], 1. * retained / total[0] if total[0] else 0, total[0] / duration if duration else 0))
 
 
 def print_stats():
@@ -116,13 +145,18 @@ if __name__ == "__main__":
     parser.add_argument('--interval', dest='interval', type=int, default=60, help='Batch size of wordlist')
     parser.add_argument('--offset', dest='offset', type=int, default=0, help='Start of wordlis')
     parser.add_argument('--limit', dest='limit', type=int, default=0, help='End of wordlist')
-    parser.add_argument('--clean', dest='clean', type=int, default=0, help='End of wordlist')
+    parser.add_argument('wordlist', nargs='?', help='Wordlist to clean with "clean"')
+    parser.add_argument('--output', dest='output', help='File to write the cleaned wordlist to')
+    parser.add_argument('--processes', dest='processes', type=int, default=1, help='Worker processes for cleaning')
+    parser.add_argument('--chunksize', dest='chunksize', type=int, default=1000, help='Words per chunk when cleaning')
     args = parser.parse_args()
     update_config(args.config)
     if args.word == "stats":
         print_stats()
     if args.word == "hist":
         print_hist()
+    elif args.word == "clean":
+        clean(args.wordlist, args.output, args.processes, args.chunksize)
     elif args.word.endswith(".wordlist") or args.word.endswith(".txt"):
         add_wordlist(args.word, args.batch_size, args.interval)
     else:
@@ -82,6 +82,8 @@ def update():
     with lcd('git_tmp'):
         local('zip -9r ../%s .' % lambdafile)
     local('zip -9 %s serapis/config/credentials.yaml' % lambdafile)
+    local('python -m serapis.compile')
+    local('zip -9 %s serapis/compile/patterns.bundle' % lambdafile)
 
     for corpus in corpora:
         local('zip -9r {} {}'.format(lambdafile, corpus))
@@ -111,7 +111,8 @@ def annotate_sentence(sentence_dict, term):
 def readability_score(url_object):
     """
     Calculates the Fleisch Reading Ease (https://simple.wikipedia.org/wiki/Flesch_Reading_Ease)
-    for a document and saves it as 'readability_score' into the url_object
+    for a document and saves it as 'readability_score' into the url_object.
+    Uses the number of sentences in 'doc_sentences' if the extractor set it.
 
     Args:
         url_object: dict
@@ -119,5 +120,5 @@ def readability_score(url_object):
     if not url_object.get('doc'):
         url_object['readability_score'] = None
         return
-    scores = Readability(url_object['doc'])
+    scores = Readability(url_object['doc'], url_object.get('doc_sentences'))
     url_object['readability_score'] = scores.fleisch_reading_ease()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmark utilities.
+
+The production model is not part of this repository, so benchmarks train a
+small stand-in pipeline with the same structure on the labeled test data.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-08"
+__email__ = "manuel@summer.ai"
+
+import os
+import math
+import json
+import time
+import datetime
+from serapis.util import read_csv, get_git_hash, hashslug, now
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "data")
+
+
+def load_labeled_sentences(filename="sentence_8000.csv"):
+    """Reads a labeled CSV from the test data.
+
+    Args:
+        filename: str -- file in serapis/tests/data with frd, term, sentence columns
+    Returns:
+        list -- (label, term, sentence) tuples
+    """
+    rows = read_csv(os.path.join(DATA_PATH, filename), skip_header=True)
+    # Some sentences contain unescaped commas
+    return [(int(row[0]), row[1], ",".join(row[2:])) for row in rows if len(row) >= 3]
+
+
+def load_term_sentences():
+    """Returns (term, sentence) pairs from sentence_8000.csv and the frds_*.csv
+    fixtures."""
+    pairs = [(term, sentence) for _, term, sentence in load_labeled_sentences("sentence_8000.csv")]
+    pairs += [(term, sentence) for _, term, sentence in load_labeled_sentences("frds_jan12.csv")]
+    pairs += [(row[0], row[1]) for row in read_csv(os.path.join(DATA_PATH, "frds_wordnik.csv")) if len(row) == 2]
+    return pairs
+
+
+def load_wordlist_terms():
+    """Returns the terms of words_disqualified.txt and the wordlist and
+    sentence fixtures, raw and cleaned, like add.py clean sees them."""
+    from serapis.preprocess import clean_term
+    with open(os.path.join(DATA_PATH, "words_disqualified.txt")) as f:
+        terms = [line.decode('utf-8').strip() for line in f]
+    terms += [row[0] for row in read_csv(os.path.join(DATA_PATH, "wordlist_duckduckgo.csv")) if row]
+    terms += [term for term, _ in load_term_sentences()]
+    return terms + [clean_term(term) for term in terms]
+
+
+def synthetic_messages(pairs, sentences_per_message=50, sentences_per_url=10):
+    """Builds messages in the format that the detect task receives.
+
+    Args:
+        pairs: list -- (term, sentence) tuples
+        sentences_per_message: int
+        sentences_per_url: int
+    Returns:
+        list -- message dicts
+    """
+    from serapis.preprocess import clean_sentence
+    messages = []
+    for start in range(0, len(pairs), sentences_per_message):
+        chunk = pairs[start:start + sentences_per_message]
+        urls = []
+        for url_start in range(0, len(chunk), sentences_per_url):
+            sentences = [{'s': sentence, 's_clean': clean_sentence(sentence, term)[0]}
+                         for term, sentence in chunk[url_start:url_start + sentences_per_url]]
+            urls.append({
+                'url': "http://example.com/{}/{}".format(start, url_start),
+                'doc': " ".join(s['s'] for s in sentences),
+                'doc_sentences': len(sentences),
+                'sentences': sentences
+            })
+        messages.append({'word': chunk[0][0], 'hashslug': hashslug(chunk[0][0]), 'crawl_date': now(), 'urls': urls})
+    return messages
+
+
+def synthetic_pages(pairs, n_pages=20, paragraphs_per_page=200, sentences_per_paragraph=5, term_share=0.1, seed=42):
+    """Builds large pages for the terms with the most sentences. Like on a
+    real page, most paragraphs are about other terms.
+
+    Args:
+        pairs: list -- (term, sentence) tuples
+        term_share: float -- share of paragraphs with a sentence containing
+                    the term
+    Returns:
+        list -- (term, page text) tuples, paragraphs separated by blank lines
+    """
+    import random
+    from collections import defaultdict
+    rng = random.Random(seed)
+    by_term = defaultdict(list)
+    for term, sentence in pairs:
+        by_term[term].append(sentence)
+    sentences = [sentence for _, sentence in pairs]
+    pages = []
+    for term in sorted(by_term, key=lambda t: -len(by_term[t]))[:n_pages]:
+        paragraphs = []
+        for _ in range(paragraphs_per_page):
+            paragraph = rng.sample(sentences, sentences_per_paragraph)
+            if rng.random() < term_share:
+                paragraph[rng.randrange(sentences_per_paragraph)] = rng.choice(by_term[term])
+            paragraphs.append(" ".join(paragraph))
+        pages.append((term, "\n\n".join(paragraphs)))
+    return pages
+
+
+def write_results(name, results, filename):
+    """Writes benchmark results as JSON, together with the git hash and date so
+    that runs on different commits can be compared."""
+    with open(filename, 'w') as f:
+        json.dump({
+            'benchmark': name,
+            'git_hash': get_git_hash(),
+            'created_at': now(),
+            'results': results
+        }, f, indent=2, sort_keys=True)
+
+
+def stage_summary(timings, n_sentences):
+    """
+    Args:
+        timings: list -- seconds per message
+        n_sentences: int -- total number of sentences processed
+    Returns:
+        dict -- total seconds, sentences/sec and p50/p99 seconds per message
+    """
+    total = sum(timings)
+    return {
+        'total': total,
+        'sentences_per_sec': n_sentences / total if total else None,
+        'p50': percentile(timings, 50),
+        'p99': percentile(timings, 99)
+    }
+
+
+def pos_strings(s_cleans):
+    """POS-tags sentences the same way as annotate.batch_tag_sentences and
+    returns just the tags, e.g. 'DT JJ NN'"""
+    from nltk import pos_tag_sents, word_tokenize
+    return [" ".join(tag for _, tag in tags) for tags in pos_tag_sents([word_tokenize(s) for s in s_cleans])]
+
+
+_labeled_data = {}  # (filename, n) -> (x, y), see labeled_data
+
+
+def labeled_data(filename="sentence_8000.csv", n=None):
+    """Cleans and POS-tags the first n labeled sentences, as detect sees them.
+    Tagging takes about a second per thousand sentences, so the result is
+    kept for the life of the process; don't modify it.
+
+    Returns:
+        tuple -- ({'s_clean': [...], 'pos': [...]}, list of labels)
+    """
+    from serapis.preprocess import clean_sentence
+    if (filename, n) not in _labeled_data:
+        rows = load_labeled_sentences(filename)[:n]
+        s_cleans = [clean_sentence(sentence, term)[0] for _, term, sentence in rows]
+        _labeled_data[(filename, n)] = ({'s_clean': s_cleans, 'pos': pos_strings(s_cleans)},
+                                        [label for label, _, _ in rows])
+    return _labeled_data[(filename, n)]
+
+
+def standin_pipeline(filename="sentence_8000.csv", k=1000, n=None, pos_tfidf=None, pos_weight=None, created_at=None):
+    """Trains a pipeline shaped like the production one (TF-IDF on s_clean with
+    SelectKBest, TF-IDF on POS tags, MultinomialNB). Also used by the tests.
+
+    Args:
+        k: int -- features of s_clean to select
+        n: int -- only train on the first n sentences of filename
+        pos_tfidf: dict -- TfidfVectorizer settings of the POS block,
+                   defaults to ngram_range (1, 3)
+        pos_weight: float -- transformer weight of the POS block
+        created_at: str -- defaults to now
+    Returns:
+        PackagedPipeline -- trained on labeled_data(filename, n)
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.feature_selection import SelectKBest
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import Pipeline, FeatureUnion
+    from serapis.learning_utils import ItemSelector
+    from serapis.persist_model import PackagedPipeline
+
+    x, y = labeled_data(filename, n)
+    feature_union = FeatureUnion(transformer_list=[
+        ('s_clean', Pipeline([
+            ('selector', ItemSelector(key='s_clean')),
+            ('tfidf', TfidfVectorizer()),
+            ('best', SelectKBest(k=k))
+        ])),
+        ('pos', Pipeline([
+            ('selector', ItemSelector(key='pos')),
+            ('tfidf', TfidfVectorizer(**(pos_tfidf or {'ngram_range': (1, 3)})))
+        ]))
+    ], transformer_weights={'pos': pos_weight} if pos_weight else None)
+    model = MultinomialNB(alpha=0.1).fit(feature_union.fit(x, y).transform(x), y)
+    metadata = {
+        'pipeline': str(model),
+        'feature_union': str(feature_union),
+        'created_at': created_at or datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+        'standin': filename
+    }
+    return PackagedPipeline(pipeline=model, feature_union=feature_union, metadata=metadata,
+                            x_train=x, y_train=y, x_test=None, y_test=None)
+
+
+def percentile(timings, p):
+    """Nearest-rank percentile of a list of timings."""
+    if not timings:
+        return None
+    ordered = sorted(timings)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def memory_usage():
+    """Returns the resident and proportional set size of this process in kB.
+    PSS splits shared pages between the processes mapping them and is None
+    where /proc/self/smaps_rollup is not available."""
+    import resource
+    usage = {'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'pss': None}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    usage['pss'] = int(line.split()[1])
+    except IOError:
+        pass
+    return usage
+
+
+class Timer(object):
+    """Context manager that records elapsed seconds in a list.
+
+    >>> timings = []
+    >>> with Timer(timings):
+    >>>     do_something()
+    """
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.timings.append(time.time() - self.start)
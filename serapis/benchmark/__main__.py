@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Benchmarks. Invoke with
+
+    python -m serapis.benchmark detect [--archive temp_models/model.zip] [--output detect.json]
+    python -m serapis.benchmark artifact [temp_models/model.zip]
+    python -m serapis.benchmark patterns
+    python -m serapis.benchmark extract [--max-sentences 20]
+    python -m serapis.benchmark qualify [--compare qualify.json]
+    python -m serapis.benchmark preprocess
+
+detect   -- Runs synthetic messages built from the sentence fixtures through
+            the stages of the detect task (POS tagging, readability, Wordnik
+            rules, model scoring) and reports sentences/sec and p50/p99 time
+            per message for each stage. --score-cache and --passes show
+            the effect of the score cache on repeated sentences.
+artifact -- Compares load time and memory of the compressed pipeline archive
+            against the uncompressed, memory-mapped one. Every load runs in a
+            fresh process; --workers processes load concurrently to show how
+            much memory they share. Also reports the size and unpickling time
+            of the vectorizer vocabularies, which are never memory-mapped.
+patterns -- Matches the Wordnik rules against the cleaned sentences of
+            sentence_8000.csv, once by running every rule's regular
+            expression and once with features.match_wordnik_rules, checks
+            that both give the same rules and reports sentences/sec.
+extract  -- Extracts the sentences with the term from large synthetic pages,
+            once sentence by sentence the way extract_sentences used to and
+            once with PageRequest.extract_sentences, checks that both give
+            the same sentences and reports pages/sec and paragraphs/sec.
+            --max-sentences also times stopping after that many sentences.
+qualify  -- Runs qualify_term and clean_and_qualify_term on the terms of
+            words_disqualified.txt and the wordlist fixtures and reports
+            words/sec. --compare reads the --output of an earlier run and
+            fails if either got slower by more than --tolerance, so new
+            rules can't quietly slow down adding wordlists.
+preprocess -- Runs preprocess_sentence on the sentence fixtures and on the
+            paragraphs of synthetic pages and reports sentences/sec.
+
+Without an archive, benchmarks train a stand-in pipeline on the test data.
+--output writes the results as JSON so they can be compared between commits.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import print_function
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-08"
+__email__ = "manuel@summer.ai"
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from serapis import benchmark
+
+
+def _load_model(archive=None, scorer=False):
+    if archive:
+        from serapis.persist_model import PackagedPipeline
+        model = PackagedPipeline.from_file(archive)
+    else:
+        print("Training stand-in pipeline...")
+        model = benchmark.standin_pipeline()
+    if scorer:
+        from serapis.scorer import LinearScorer
+        model = LinearScorer.from_pipeline(model)
+    return model
+
+
+def bench_detect(archive=None, scorer=False, sentences_per_message=50, limit=None, cache_size=None, passes=1):
+    """
+    Args:
+        cache_size: int -- score with a ScoreCache of this size
+        passes: int -- run all messages this many times, e.g. to see the
+                score cache warm up
+    Returns:
+        dict -- maps each stage to total seconds, sentences/sec and p50/p99
+                seconds per message
+    """
+    from serapis.annotate import batch_tag_sentences, readability_score
+    from serapis.features import match_wordnik_rules_batch
+    from serapis.tasks import score_sentences
+    from serapis.score_cache import ScoreCache
+
+    model = _load_model(archive, scorer)
+    score_cache = ScoreCache(cache_size) if cache_size else None
+    pairs = benchmark.load_term_sentences()[:limit]
+    messages = benchmark.synthetic_messages(pairs, sentences_per_message) * passes
+    n_sentences = sum(len(url['sentences']) for message in messages for url in message['urls'])
+    print("Running {} messages with {} sentences...".format(len(messages), n_sentences))
+
+    def tag(message, sentences):
+        batch_tag_sentences(message)
+
+    def readability(message, sentences):
+        for url_object in message['urls']:
+            readability_score(url_object)
+
+    def patterns(message, sentences):
+        patterns = match_wordnik_rules_batch([sentence['s_clean'] for sentence in sentences], as_matrix=False)
+        for sentence, sentence_patterns in zip(sentences, patterns):
+            sentence['patterns'] = sentence_patterns
+
+    def score(message, sentences):
+        score_sentences([('primary', model)], sentences, score_cache)
+
+    stages = (('tag', tag), ('readability', readability), ('patterns', patterns), ('score', score))
+    timings = {name: [] for name, _ in stages}
+    for message in messages:
+        sentences = [s for url in message['urls'] for s in url['sentences']]
+        for name, stage in stages:
+            with benchmark.Timer(timings[name]):
+                stage(message, sentences)
+
+    timings['total'] = [sum(t) for t in zip(*[timings[name] for name, _ in stages])]
+    results = {name: benchmark.stage_summary(t, n_sentences) for name, t in timings.items()}
+    results['messages'] = len(messages)
+    results['sentences'] = n_sentences
+    if score_cache is not None:
+        results['score_cache'] = score_cache.stats()
+        print("Score cache: {hits} hits, {misses} misses, {size} entries".format(**results['score_cache']))
+    for name in [name for name, _ in stages] + ['total']:
+        print("{:>12}: {:>10.1f} sentences/sec, p50 {:.4f}s, p99 {:.4f}s per message".format(
+            name, results[name]['sentences_per_sec'], results[name]['p50'], results[name]['p99']))
+    return results
+
+
+def bench_patterns(filename="sentence_8000.csv", runs=3, profile=None, budget=None):
+    """
+    Args:
+        profile: str -- after timing, profile every rule and write the report
+                 as JSON to this file
+        budget: float -- time budget per rule and sentence while profiling
+    Returns:
+        dict -- sentences/sec of every regex vs. match_wordnik_rules
+    """
+    from serapis.features import get_rules, match_wordnik_rules, RuleProfiler
+    from serapis.preprocess import clean_sentence
+    patterns = get_rules().patterns
+
+    s_cleans = [clean_sentence(sentence, term)[0] for _, term, sentence in benchmark.load_labeled_sentences(filename)]
+
+    def every_regex(s_clean):
+        s_clean = s_clean.replace("'_TERM_'", "_TERM_").replace(",", "").lower()
+        return [rule for rule, pattern in patterns.items() if pattern.search(s_clean)]
+
+    results = {'sentences': len(s_cleans)}
+    matches = {}
+    for name, match in (('every_regex', every_regex), ('match_wordnik_rules', match_wordnik_rules)):
+        timings = []
+        for _ in range(runs):
+            with benchmark.Timer(timings):
+                matches[name] = [match(s_clean) for s_clean in s_cleans]
+        results[name] = len(s_cleans) / min(timings)
+        print("{:>20}: {:>10.1f} sentences/sec".format(name, results[name]))
+    mismatches = sum(a != b for a, b in zip(matches['every_regex'], matches['match_wordnik_rules']))
+    results['mismatches'] = mismatches
+    print("{} of {} sentences match different rules".format(mismatches, len(s_cleans)))
+
+    if profile:
+        get_rules().profiler = profiler = RuleProfiler(budget)
+        for s_clean in s_cleans:
+            match_wordnik_rules(s_clean)
+        get_rules().profiler = None
+        print(profiler.report().encode("utf-8"))
+        profiler.dump(profile)
+    return results
+
+
+def bench_extract(n_pages=20, paragraphs_per_page=200, max_sentences=None):
+    """
+    Returns:
+        dict -- pages/sec and paragraphs/sec of each way of extracting
+    """
+    from serapis.extract import PageRequest
+    from serapis.language import is_english
+    from serapis.preprocess import paragraph_to_sentences, qualify_sentence, clean_sentence
+
+    pages = benchmark.synthetic_pages(benchmark.load_term_sentences(), n_pages, paragraphs_per_page)
+    print("Extracting from {} pages with {} paragraphs each...".format(len(pages), paragraphs_per_page))
+
+    def per_sentence(term, page_text):
+        result = []
+        for paragraph in page_text.split('\n\n'):
+            if is_english(paragraph):
+                for sentence in paragraph_to_sentences(paragraph, term):
+                    if qualify_sentence(sentence):
+                        s_clean, variants = clean_sentence(sentence, term)
+                        if variants and s_clean not in [s['s_clean'] for s in result]:
+                            result.append({'s': sentence, 's_clean': s_clean})
+        return result
+
+    def extract(term, page_text, max_sentences=None, narrow=False):
+        page = PageRequest(None, term, run=False)
+        page.extract_sentences(page_text, max_sentences, narrow)
+        return page.sentences
+
+    runs = [('per_sentence', per_sentence), ('extract_sentences', extract),
+            ('narrow_page_text', lambda term, page_text: extract(term, page_text, narrow=True))]
+    if max_sentences:
+        runs.append(('max_sentences', lambda term, page_text: extract(term, page_text, max_sentences, True)))
+    results = {'pages': len(pages), 'paragraphs_per_page': paragraphs_per_page}
+    sentences = {}
+    for name, run in runs:
+        timings = []
+        with benchmark.Timer(timings):
+            sentences[name] = [run(term, page_text) for term, page_text in pages]
+        results[name] = {
+            'pages_per_sec': len(pages) / timings[0],
+            'paragraphs_per_sec': len(pages) * paragraphs_per_page / timings[0],
+            'sentences': sum(len(s) for s in sentences[name])
+        }
+        print("{:>20}: {:>8.2f} pages/sec, {:>8.1f} paragraphs/sec, {} sentences".format(
+            name, results[name]['pages_per_sec'], results[name]['paragraphs_per_sec'], results[name]['sentences']))
+    mismatches = sum(a != b or a != c for a, b, c in zip(sentences['per_sentence'], sentences['extract_sentences'],
+                                                         sentences['narrow_page_text']))
+    results['mismatches'] = mismatches
+    print("{} of {} pages give different sentences".format(mismatches, len(pages)))
+    return results
+
+
+def bench_qualify(runs=5, compare=None, tolerance=0.2):
+    """
+    Args:
+        compare: str -- results file of an earlier run
+        tolerance: float -- allowed slowdown relative to compare
+    Returns:
+        dict -- words/sec of qualify_term and clean_and_qualify_term
+    """
+    from serapis.preprocess import qualify_term, clean_and_qualify_term
+
+    terms = benchmark.load_wordlist_terms()
+    results = {'terms': len(terms), 'qualified': sum(map(bool, map(qualify_term, terms)))}
+    for name, qualify in (('qualify_term', qualify_term), ('clean_and_qualify_term', clean_and_qualify_term)):
+        timings = []
+        for _ in range(runs):
+            with benchmark.Timer(timings):
+                map(qualify, terms)
+        results[name] = len(terms) / min(timings)
+        print("{:>24}: {:>10.0f} words/sec".format(name, results[name]))
+
+    if compare:
+        with open(compare) as f:
+            previous = json.load(f)['results']
+        slower = [name for name in ('qualify_term', 'clean_and_qualify_term')
+                  if results[name] < (1 - tolerance) * previous[name]]
+        for name in ('qualify_term', 'clean_and_qualify_term'):
+            print("{:>24}: {:.0%} of {}".format(name, results[name] / previous[name], compare))
+        results['slower'] = slower
+    return results
+
+
+def bench_preprocess(runs=3, n_pages=10, paragraphs_per_page=100):
+    """
+    Returns:
+        dict -- sentences/sec of preprocess_sentence on fixture sentences and
+                on whole paragraphs
+    """
+    from serapis.preprocess import preprocess_sentence, TermContext
+
+    pairs = benchmark.load_term_sentences()
+    paragraphs = [(term, paragraph) for term, page_text in benchmark.synthetic_pages(pairs, n_pages, paragraphs_per_page)
+                  for paragraph in page_text.split("\n\n")]
+    contexts = {term: TermContext(term) for term, _ in pairs}
+    results = {}
+    for name, items in (('sentences', pairs), ('paragraphs', paragraphs)):
+        items = [(contexts[term], text) for term, text in items]
+        timings = []
+        for _ in range(runs):
+            with benchmark.Timer(timings):
+                for context, text in items:
+                    preprocess_sentence(text, context)
+        results[name] = {'count': len(items), 'sentences_per_sec': len(items) / min(timings)}
+        print("{:>12}: {:>10.0f} sentences/sec".format(name, results[name]['sentences_per_sec']))
+    return results
+
+
+def load_archive(archive, hold=0):
+    """Loads an archive in this process and prints timing and memory as JSON."""
+    start = time.time()
+    from serapis.persist_model import PackagedPipeline
+    imported = time.time()
+    PackagedPipeline.from_file(archive)
+    loaded = time.time()
+    time.sleep(hold)  # Keep the pipeline mapped while sibling processes load theirs
+    result = {'import': imported - start, 'load': loaded - imported}
+    result.update(benchmark.memory_usage())
+    print(json.dumps(result))
+
+
+def _spawn(archive, hold=0):
+    return subprocess.Popen([sys.executable, "-m", "serapis.benchmark", "_load", archive, "--hold", str(hold)],
+                            stdout=subprocess.PIPE)
+
+
+def _collect(process):
+    out, _ = process.communicate()
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _vocabulary_costs(pipeline, runs=5):
+    """The vectorizer vocabularies are dicts inside the pickled feature union,
+    so every process unpickles them in full and none of them is memory-mapped.
+
+    Returns:
+        dict -- number of entries, pickled size and unpickling time of all
+                vocabularies
+    """
+    import cPickle as pickle
+    vocabularies = [step.vocabulary_ for _, block in pipeline._feature_union.transformer_list
+                    for _, step in getattr(block, 'steps', [('', block)]) if hasattr(step, 'vocabulary_')]
+    pickled = pickle.dumps(vocabularies, pickle.HIGHEST_PROTOCOL)
+    timings = []
+    for _ in range(runs):
+        with benchmark.Timer(timings):
+            pickle.loads(pickled)
+    return {'entries': sum(len(v) for v in vocabularies), 'size': len(pickled), 'load': min(timings)}
+
+
+def bench_artifact(archive=None, runs=5, workers=4):
+    """
+    Returns:
+        dict -- maps format to load times and memory usage, and
+                'vocabulary' to the share of the vectorizer vocabularies
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pipeline = _load_model(archive)
+        results = {'vocabulary': _vocabulary_costs(pipeline, runs)}
+        print("vocabulary: {entries:,} entries, {size:,} bytes pickled, unpickled in {load:.3f}s "
+              "by every process".format(**results['vocabulary']))
+        for name, mmap in (('zip', False), ('mmap', True)):
+            filename = pipeline.pack(os.path.join(tmp_dir, "{}.zip".format(name)), mmap=mmap)
+            runs_ = [_collect(_spawn(filename)) for _ in range(runs)]
+            concurrent = [_collect(p) for p in [_spawn(filename, hold=2) for _ in range(workers)]]
+            pss = [r['pss'] for r in concurrent]
+            results[name] = {
+                'size': os.path.getsize(filename),
+                'load_first': runs_[0]['load'],
+                'load_p50': benchmark.percentile([r['load'] for r in runs_[1:] or runs_], 50),
+                'max_rss': benchmark.percentile([r['max_rss'] for r in runs_], 50),
+                'workers': workers,
+                'pss_total': sum(pss) if None not in pss else None,
+            }
+            print("{:>5}: {:>10,} bytes, first load {:.3f}s, then {:.3f}s, max RSS {:,} kB, "
+                  "{} workers PSS {} kB".format(name, results[name]['size'], results[name]['load_first'],
+                                                results[name]['load_p50'], results[name]['max_rss'],
+                                                workers, results[name]['pss_total']))
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serapis benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    detect = subparsers.add_parser('detect', help='Throughput of the detect stages')
+    detect.add_argument('--archive', help='Pipeline archive (trains a stand-in if omitted)')
+    detect.add_argument('--scorer', action='store_true', help='Score with the compiled LinearScorer')
+    detect.add_argument('--sentences', type=int, default=50, help='Sentences per message')
+    detect.add_argument('--limit', type=int, help='Only use the first n sentences')
+    detect.add_argument('--score-cache', type=int, help='Score with a ScoreCache of this size')
+    detect.add_argument('--passes', type=int, default=1, help='Run all messages this many times')
+    detect.add_argument('--output', help='Write results as JSON to this file')
+
+    artifact = subparsers.add_parser('artifact', help='Pipeline archive load time and memory')
+    artifact.add_argument('archive', nargs='?', help='Pipeline archive (trains a stand-in if omitted)')
+    artifact.add_argument('--runs', type=int, default=5, help='Sequential loads per format')
+    artifact.add_argument('--workers', type=int, default=4, help='Concurrent loads per format')
+    artifact.add_argument('--output', help='Write results as JSON to this file')
+
+    patterns = subparsers.add_parser('patterns', help='Throughput of the Wordnik rules')
+    patterns.add_argument('--runs', type=int, default=3, help='Report the fastest of this many runs')
+    patterns.add_argument('--profile', help='Write a per-rule profile as JSON to this file')
+    patterns.add_argument('--budget', type=float, help='Time budget per rule and sentence while profiling')
+    patterns.add_argument('--output', help='Write results as JSON to this file')
+
+    extract = subparsers.add_parser('extract', help='Throughput of extracting sentences from pages')
+    extract.add_argument('--pages', type=int, default=20, help='Number of pages')
+    extract.add_argument('--paragraphs', type=int, default=200, help='Paragraphs per page')
+    extract.add_argument('--max-sentences', type=int, help='Also time stopping after this many sentences per page')
+    extract.add_argument('--output', help='Write results as JSON to this file')
+
+    qualify = subparsers.add_parser('qualify', help='Throughput of qualifying terms')
+    qualify.add_argument('--runs', type=int, default=5, help='Report the fastest of this many runs')
+    qualify.add_argument('--compare', help='Fail if slower than the results in this file')
+    qualify.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown with --compare')
+    qualify.add_argument('--output', help='Write results as JSON to this file')
+
+    preprocess = subparsers.add_parser('preprocess', help='Throughput of preprocess_sentence')
+    preprocess.add_argument('--runs', type=int, default=3, help='Report the fastest of this many runs')
+    preprocess.add_argument('--output', help='Write results as JSON to this file')
+
+    load = subparsers.add_parser('_load')
+    load.add_argument('archive')
+    load.add_argument('--hold', type=float, default=0)
+
+    args = parser.parse_args()
+    if args.benchmark == '_load':
+        load_archive(args.archive, args.hold)
+    elif args.benchmark == 'detect':
+        results = bench_detect(args.archive, args.scorer, args.sentences, args.limit,
+                               args.score_cache, args.passes)
+    elif args.benchmark == 'artifact':
+        results = bench_artifact(args.archive, args.runs, args.workers)
+    elif args.benchmark == 'patterns':
+        results = bench_patterns(runs=args.runs, profile=args.profile, budget=args.budget)
+    elif args.benchmark == 'extract':
+        results = bench_extract(args.pages, args.paragraphs, args.max_sentences)
+    elif args.benchmark == 'qualify':
+        results = bench_qualify(args.runs, args.compare, args.tolerance)
+    elif args.benchmark == 'preprocess':
+        results = bench_preprocess(args.runs)
+    if args.benchmark != '_load' and args.output:
+        benchmark.write_results(args.benchmark, results, args.output)
+    if args.benchmark == 'qualify' and results.get('slower'):
+        sys.exit("Slower than {}: {}".format(args.compare, ", ".join(results['slower'])))
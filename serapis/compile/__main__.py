@@ -17,7 +17,10 @@ __date__ = "2015-11-25"
 __email__ = "manuel@1450.me"
 
 from serapis import patterns
+from serapis.features import RuleSet, BUNDLE_FILE
 
 if __name__ == "__main__":
     print("Compiling patterns...")
-    patterns = patterns.compile()
+    rules = RuleSet.from_patterns(patterns.compile())
+    rules.save(BUNDLE_FILE, patterns.checksum())
+    print("Wrote {} rules to {}".format(len(rules.rules), BUNDLE_FILE))
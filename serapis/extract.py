@@ -18,8 +18,8 @@ import html2text
 from bs4 import BeautifulSoup
 from serapis.util import squashed
 from serapis.language import is_english
-from serapis.preprocess import paragraph_to_sentences, qualify_sentence, clean_sentence
-from serapis.util import get_source_from_url
+from serapis.preprocess import paragraphs_to_sentences, TermContext, VariantScan
+from serapis.util import get_source_from_url, batch
 import re
 import logging
 
@@ -31,6 +31,57 @@ for option in ('ignore_links', 'ignore_images', 'ignore_emphasis', 'bypass_table
 html_parser.body_width = 0
 
 
+def term_paragraphs(paragraphs, context, n_context=0):
+    """Yields the paragraphs that may contain the term (see
+    TermContext.may_contain), and up to n_context paragraphs before and
+    after each of them, so the page text keeps some context around the term.
+
+    Args:
+        paragraphs: list -- str
+        context: TermContext
+        n_context: int
+    """
+    keep = set()
+    for idx, paragraph in enumerate(paragraphs):
+        if context.may_contain(paragraph):
+            keep.update(range(idx - n_context, idx + n_context + 1))
+    for idx, paragraph in enumerate(paragraphs):
+        if idx in keep:
+            yield paragraph
+
+
+def english_paragraphs(paragraphs):
+    """Yields the English paragraphs."""
+    for paragraph in paragraphs:
+        if is_english(paragraph):
+            yield paragraph
+
+
+def term_sentences(paragraphs, context, batch_size=10):
+    """Yields every qualified sentence of the paragraphs, cleaned.
+
+    Paragraphs are segmented batch_size at a time, see
+    preprocess.paragraphs_to_sentences, so a caller that stops early leaves
+    at most one batch unused. The variants of each paragraph are found in one
+    scan, see preprocess.VariantScan.
+
+    Args:
+        paragraphs: iterable -- str
+        context: TermContext
+        batch_size: int -- paragraphs to segment at once
+    Yields:
+        tuple -- sentence, s_clean and the set of variants in the sentence
+    """
+    for paragraph_batch in batch((paragraph for paragraph in paragraphs), batch_size):
+        for sentences in paragraphs_to_sentences(paragraph_batch, context):  # Only returns qualified sentences
+            scan = VariantScan(" ".join(sentences), context)
+            start = 0
+            for sentence in sentences:
+                s_clean, variants = scan.clean(start, start + len(sentence))
+                start += len(sentence) + 1
+                yield sentence, s_clean, variants
+
+
 class PageRequest(object):
     """
     Requests and parses a single page.
@@ -61,28 +112,49 @@ class PageRequest(object):
         log.error("Failed to return page for url: %s" % self.url)
         return None
 
-    def extract_sentences(self, page_text):
+    def extract_sentences(self, page_text, max_sentences=None, narrow=None):
         """Finds all sentences that contain the term or a spelling variants.
-        Sets self.sentences ans self.variants.
+        Sets self.sentences ans self.variants, and self.doc_sentences to the
+        number of sentences in the cleaned page text.
+
+        The cleaned page text has all English sentences of the page, and
+        max_sentences only limits self.sentences. With narrow, only paragraphs
+        that may contain the term and the config.paragraph_context paragraphs
+        around them are checked for language and tokenized, and the page is
+        processed lazily, so with max_sentences the rest of the page is never
+        tokenized. The cleaned page text is then made up of just these
+        sentences, which changes its readability score.
 
         Args:
             page_text: str
+            max_sentences: int -- stop after this many sentences with the
+                           term, defaults to config.max_sentences_per_page
+            narrow: bool -- defaults to config.narrow_page_text
         Returns
             str -- cleaned page text.
         """
+        max_sentences = max_sentences or config.max_sentences_per_page
+        narrow = config.narrow_page_text if narrow is None else narrow
+        seen = set(s['s_clean'] for s in self.sentences)
         doc = []
-        for paragraph in page_text.split('\n\n'):
-            if is_english(paragraph):
-                for sentence in paragraph_to_sentences(paragraph, self.term):
-                    if qualify_sentence(sentence):
-                        doc.append(sentence)
-                        s_clean, variants = clean_sentence(sentence, self.term)
-                        if variants and s_clean not in [s['s_clean'] for s in self.sentences]:
-                            self.variants.update(variants)
-                            self.sentences.append({
-                                's': sentence,
-                                's_clean': s_clean
-                            })
+        context = TermContext(self.term)
+        paragraphs = page_text.split('\n\n')
+        if narrow:
+            paragraphs = term_paragraphs(paragraphs, context, config.paragraph_context or 0)
+        for sentence, s_clean, variants in term_sentences(english_paragraphs(paragraphs), context):
+            doc.append(sentence)
+            if max_sentences and len(self.sentences) >= max_sentences:
+                continue  # Only the page text is still needed
+            if variants and s_clean not in seen:
+                seen.add(s_clean)
+                self.variants.update(variants)
+                self.sentences.append({
+                    's': sentence,
+                    's_clean': s_clean
+                })
+                if narrow and max_sentences and len(self.sentences) >= max_sentences:
+                    break
+        self.doc_sentences = len(doc)
         return " ".join(doc)
 
     def get_meta(self, page_html):
@@ -154,6 +226,7 @@ class PageRequest(object):
             "url": self.url,
             "source": get_source_from_url(self.url),
             "doc": self.text,
+            "doc_sentences": self.doc_sentences,
             "features": self.features,
             "variants": list(self.variants),  # Sets are not JSON serializable
             "sentences": self.sentences,
@@ -177,6 +250,7 @@ class PageRequest(object):
         self.variants = set()
         self.sentences = []
         self.text = ""
+        self.doc_sentences = None
         self.html = ""
         self.features = {}
         self.author = None
@@ -221,4 +295,5 @@ class DiffbotRequest(PageRequest):
         self.title = obj.get('title')
 
         self.extract_sentences(self.html)
+        self.doc_sentences = None  # self.text is Diffbot's, not the extracted sentences
         self.get_html_features(self.html)
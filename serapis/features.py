@@ -11,12 +11,334 @@ __copyright__ = "Copyright 2015, summer.ai"
 __date__ = "2015-11-24"
 __email__ = "manuel@summer.ai"
 
+import os
 import re
+import sys
+import json
+import time
+import bisect
+import _sre
+import logging
+import sre_parse
+import sre_compile
+import sre_constants
+import cPickle as pickle
+from collections import OrderedDict
+import numpy as np
+from serapis.config import config
 import serapis.patterns
 
-patterns = serapis.patterns.compile()
-for rule, pattern in patterns.items():
-    patterns[rule] = re.compile(pattern, re.IGNORECASE)
+log = logging.getLogger('serapis.features')
+
+BUNDLE_VERSION = 3
+TERM = "_term_"
+BUNDLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compile", "patterns.bundle")
+
+
+def literal_anchors(pattern):
+    """Returns substrings that every match of a pattern must contain, i.e.
+    the runs of plain ASCII characters at the top level of the pattern,
+    lowercased. E.g. "_TERM_ (or )?in other words" has the anchors
+    ["_term_ ", "in other words"].
+
+    Args:
+        pattern: str -- regular expression
+    Returns:
+        list -- str
+    """
+    anchors, run = [], []
+    for op, av in sre_parse.parse(pattern):
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(chr(av).lower())
+        elif run:
+            anchors.append("".join(run))
+            run = []
+    if run:
+        anchors.append("".join(run))
+    return anchors
+
+
+def term_width(pattern, anchors):
+    """Returns the maximum length of a match of pattern if every match
+    contains _TERM_ (i.e. one of its anchors does), otherwise None.
+
+    Args:
+        pattern: str -- regular expression
+        anchors: list -- see literal_anchors
+    Returns:
+        int
+    """
+    if not any(TERM in anchor for anchor in anchors):
+        return None
+    width = sre_parse.parse(pattern, re.IGNORECASE).getwidth()[1]
+    return width if width < sre_constants.MAXREPEAT else None
+
+
+def term_windows(positions, width, length):
+    """Returns the parts of a sentence that contain every match of a rule
+    with the given term_width, i.e. the windows around each _TERM_,
+    merged where they overlap. Windows reach one character past the longest
+    match so that assertions like \\b see the real next character.
+
+    Args:
+        positions: list -- start of each _TERM_ in the sentence
+        width: int -- see term_width
+        length: int -- length of the sentence
+    Returns:
+        list -- (start, end) tuples
+    """
+    windows = []
+    for position in positions:
+        start, end = max(0, position + len(TERM) - width), min(length, position + width + 1)
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], end)
+        else:
+            windows.append((start, end))
+    return windows
+
+
+class RuleProfiler(object):
+    """
+    Records per-rule call counts, hit counts, cumulative and worst-case time
+    and the sentence that caused the worst case.
+
+    >>> get_rules().profiler = RuleProfiler(budget=0.05)
+    >>> ...
+    >>> print(get_rules().profiler.report())
+
+    With a budget, every call of a rule that takes longer is logged and
+    counted. Python can't interrupt a running regular expression, so with
+    skip=True the rule is instead not run on later sentences at least as long
+    as `overruns` sentences that exceeded the budget (it counts as not
+    matching). A single slow call, e.g. during garbage collection, doesn't
+    disable a rule.
+    """
+
+    def __init__(self, budget=None, skip=False, overruns=3):
+        """
+        Args:
+            budget: float -- seconds a rule may take on a single sentence
+            skip: bool -- skip rules on sentences like the ones that exceeded
+                  the budget, instead of just flagging them
+            overruns: int -- sentences that must exceed the budget before a
+                      rule is skipped on sentences at least as long
+        """
+        self.budget = budget
+        self.skip = skip
+        self.overruns = overruns
+        self.stats = {}
+        self.overrun_lengths = {}  # rule -> sorted lengths of the shortest sentences that exceeded the budget
+
+    def allows(self, rule, s_clean):
+        """Returns False if the rule should be skipped on this sentence."""
+        if not self.skip:
+            return True
+        lengths = self.overrun_lengths.get(rule, ())
+        return len(lengths) < self.overruns or len(s_clean) < lengths[-1]
+
+    def record(self, rule, s_clean, elapsed, hit):
+        stats = self.stats.get(rule)
+        if stats is None:
+            stats = self.stats[rule] = {'calls': 0, 'hits': 0, 'skipped': 0, 'over_budget': 0,
+                                        'time': 0.0, 'worst_time': 0.0, 'worst_sentence': None}
+        if elapsed is None:
+            stats['skipped'] += 1
+            return
+        stats['calls'] += 1
+        stats['hits'] += 1 if hit else 0
+        stats['time'] += elapsed
+        if elapsed > stats['worst_time']:
+            stats['worst_time'] = elapsed
+            stats['worst_sentence'] = s_clean
+        if self.budget and elapsed > self.budget:
+            stats['over_budget'] += 1
+            lengths = self.overrun_lengths.setdefault(rule, [])
+            bisect.insort(lengths, len(s_clean))
+            del lengths[self.overruns:]
+            log.warning("Rule %s took %.4fs (budget %.4fs) on '%s'" % (rule, elapsed, self.budget, s_clean))
+
+    def report(self):
+        """Returns the statistics as a table, slowest rules first."""
+        lines = ["{:<12} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10}  {}".format(
+            "rule", "calls", "hits", "skipped", "budget", "time", "worst", "worst sentence")]
+        for rule, stats in sorted(self.stats.items(), key=lambda item: -item[1]['time']):
+            lines.append("{:<12} {calls:>8} {hits:>8} {skipped:>8} {over_budget:>8} {time:>10.4f} {worst_time:>10.6f}  {}".format(
+                rule, (stats['worst_sentence'] or "")[:80], **stats))
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        """Writes the statistics as JSON."""
+        with open(filename, 'w') as f:
+            json.dump({'budget': self.budget, 'skip': self.skip, 'rules': self.stats}, f, indent=2, sort_keys=True)
+
+
+class RuleSet(object):
+    """
+    Matches all Wordnik rules against a sentence at once.
+
+    Most rules require _TERM_ and a fixed phrase such as "in other words", so
+    instead of running every regular expression on every sentence, RuleSet
+    first checks which anchors (see literal_anchors) occur in the sentence
+    and only runs the rules whose anchors are all present. Rules whose
+    matches always contain _TERM_ and have a bounded length only search the
+    windows around each _TERM_ (see term_windows), so long sentences don't
+    cost more than short ones. The result is the same as running all rules
+    on the whole sentence.
+
+    Properties:
+        patterns: OrderedDict -- maps rule names to compiled patterns
+        profiler: RuleProfiler -- if set, match times every rule
+    """
+
+    def __init__(self, rules):
+        """
+        Args:
+            rules: list -- (rule name, compiled pattern, anchors, term width)
+                   tuples, in the order in which matching rules are returned
+        """
+        self.rules = rules
+        self.names = [rule for rule, _, _, _ in rules]
+        self.patterns = OrderedDict((rule, regex) for rule, regex, _, _ in rules)
+        self.anchors = sorted(set(anchor for _, _, anchors, _ in self.rules for anchor in anchors))
+        self.profiler = None
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        """
+        Args:
+            patterns: dict -- maps rule names to regular expressions, e.g.
+                      the result of serapis.patterns.compile()
+        Returns:
+            RuleSet
+        """
+        rules = []
+        for rule, pattern in patterns.items():
+            anchors = literal_anchors(pattern)
+            rules.append((rule, re.compile(pattern, re.IGNORECASE), anchors, term_width(pattern, anchors)))
+        return cls(rules)
+
+    def save(self, filename, checksum):
+        """Writes the rules as a bundle of compiled regular expression code,
+        so that loading them skips parsing and compiling.
+
+        Args:
+            filename: str
+            checksum: str -- see serapis.patterns.checksum
+        """
+        rules = []
+        for rule, regex, anchors, width in self.rules:
+            parsed = sre_parse.parse(regex.pattern, re.IGNORECASE)
+            code = sre_compile._code(parsed, re.IGNORECASE)
+            indexgroup = [None] * parsed.pattern.groups
+            for name, index in parsed.pattern.groupdict.items():
+                indexgroup[index] = name
+            rules.append((rule, regex.pattern, re.IGNORECASE | parsed.pattern.flags, code,
+                          parsed.pattern.groups - 1, parsed.pattern.groupdict, indexgroup, anchors, width))
+        bundle = {
+            'version': BUNDLE_VERSION,
+            'python': tuple(sys.version_info[:2]),
+            'sre_magic': _sre.MAGIC,
+            'checksum': checksum,
+            'rules': rules
+        }
+        with open(filename, 'wb') as f:
+            pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+        return filename
+
+    @classmethod
+    def load(cls, filename, checksum):
+        """Loads a bundle written by save.
+
+        Raises:
+            ValueError -- if the bundle was written by another version of
+                          serapis or Python, or from other patterns
+        """
+        with open(filename, 'rb') as f:
+            bundle = pickle.load(f)
+        if (bundle['version'], bundle['python'], bundle['sre_magic']) != (BUNDLE_VERSION, tuple(sys.version_info[:2]), _sre.MAGIC):
+            raise ValueError("Pattern bundle {} was written by another version".format(filename))
+        if bundle['checksum'] != checksum:
+            raise ValueError("Pattern bundle {} is out of date".format(filename))
+        return cls([(rule, _sre.compile(pattern, flags, code, groups, groupindex, indexgroup), anchors, width)
+                    for rule, pattern, flags, code, groups, groupindex, indexgroup, anchors, width in bundle['rules']])
+
+    def match(self, s_clean):
+        """
+        Args:
+            s_clean: str -- lowercased sentence
+        Returns:
+            list -- names of all matching rules
+        """
+        present = set(anchor for anchor in self.anchors if anchor in s_clean)
+        positions, windows = [], {}
+        if any(TERM in anchor for anchor in present):
+            position = s_clean.find(TERM)
+            while position >= 0:
+                positions.append(position)
+                position = s_clean.find(TERM, position + 1)
+
+        matches = []
+        profiler = self.profiler
+        for rule, regex, anchors, width in self.rules:
+            if not present.issuperset(anchors):
+                continue
+            if width is not None and width not in windows:
+                windows[width] = term_windows(positions, width, len(s_clean))
+            if profiler is None:
+                hit = self._search(regex, s_clean, windows.get(width))
+            elif profiler.allows(rule, s_clean):
+                start = time.time()
+                hit = self._search(regex, s_clean, windows.get(width))
+                profiler.record(rule, s_clean, time.time() - start, hit)
+            else:
+                hit = False
+                profiler.record(rule, s_clean, None, hit)
+            if hit:
+                matches.append(rule)
+        return matches
+
+    @staticmethod
+    def _search(regex, s_clean, windows=None):
+        """Returns True if regex matches s_clean, only searching the given
+        windows if there are any (see term_windows)."""
+        if windows is None:
+            return bool(regex.search(s_clean))
+        for start, end in windows:
+            match = regex.search(s_clean, start, end)
+            if match:
+                # Confirm on the whole sentence, in case the match relied on the end of the window
+                return bool(regex.match(s_clean, match.start()) or regex.search(s_clean))
+        return False
+
+
+def load_rules(filename=BUNDLE_FILE):
+    """Loads the bundle written by `python -m serapis.compile`, or compiles
+    the patterns if there is no up-to-date bundle.
+
+    Returns:
+        RuleSet
+    """
+    try:
+        return RuleSet.load(filename, serapis.patterns.checksum())
+    except Exception, e:
+        log.info("Compiling patterns at runtime: %s" % e)
+        return RuleSet.from_patterns(serapis.patterns.compile())
+
+
+_rules = None
+
+
+def get_rules():
+    """Returns the RuleSet, loading it on first use. Attaches a RuleProfiler
+    if config.profile_patterns or config.pattern_time_budget is set."""
+    global _rules
+    if _rules is None:
+        rules = load_rules()
+        if config.profile_patterns or config.pattern_time_budget:
+            rules.profiler = RuleProfiler(config.pattern_time_budget, config.pattern_budget_action == 'skip',
+                                          config.pattern_budget_overruns)
+        _rules = rules
+    return _rules
 
 
 def match_wordnik_rules(s_clean):
@@ -26,5 +348,48 @@ def match_wordnik_rules(s_clean):
 
     Returns [u'KO16', u'KO3']
     """
-    s_clean = s_clean.replace("'_TERM_'", "_TERM_").replace(",", "").lower()
-    return [rule for rule, pattern in patterns.items() if pattern.search(s_clean.lower())]
+    return get_rules().match(_prepare(s_clean))
+
+
+def match_wordnik_rules_batch(s_cleans, rules=None, as_matrix=True):
+    """Matches the rules against many sentences, e.g. a whole training set,
+    and returns a sentence x rule indicator matrix that can be used as a
+    block of a FeatureUnion (see learning_utils.WordnikRules).
+
+    Duplicate sentences, which are common in crawled training data, are only
+    matched once.
+
+    Args:
+        s_cleans: list -- sentences
+        rules: list -- names of the rules to return as columns, in this
+               order. Defaults to all rules
+        as_matrix: bool -- if False, returns the same lists of rule names as
+                   match_wordnik_rules instead of a matrix (and doesn't
+                   import scipy)
+    Returns:
+        scipy.sparse.csr_matrix -- (n_sentences, n_rules), 1 where a rule
+                                   matches a sentence
+    """
+    rule_set = get_rules()
+    seen = {}
+    matches = []
+    for s_clean in s_cleans:
+        s_clean = _prepare(s_clean)
+        if s_clean not in seen:
+            seen[s_clean] = rule_set.match(s_clean)
+        matches.append(seen[s_clean])
+    if not as_matrix:
+        return [list(rule_names) for rule_names in matches]
+
+    from scipy import sparse
+    columns = {rule: col for col, rule in enumerate(rules or rule_set.names)}
+    indices, indptr = [], [0]
+    for rule_names in matches:
+        indices.extend(sorted(columns[rule] for rule in rule_names if rule in columns))
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.float64), indices, indptr),
+                             shape=(len(matches), len(columns)))
+
+
+def _prepare(s_clean):
+    return s_clean.replace("'_TERM_'", "_TERM_").replace(",", "").lower()
@@ -7,6 +7,7 @@ Utilities for Machine Learning
 from sklearn.base import BaseEstimator, TransformerMixin
 from nltk.stem.porter import PorterStemmer
 from nltk import word_tokenize
+from serapis.features import get_rules, match_wordnik_rules_batch
 
 
 class ItemSelector(BaseEstimator, TransformerMixin):
@@ -52,6 +53,33 @@ class ItemSelector(BaseEstimator, TransformerMixin):
         return data_dict[self.key]
 
 
+class WordnikRules(BaseEstimator, TransformerMixin):
+    """
+    Turns sentences into a sparse (n_samples, n_rules) matrix of the Wordnik
+    rules that match them, so the rules can be a block of a FeatureUnion:
+
+    >> FeatureUnion([('s_clean', ...), ('pos', ...), ('rules', WordnikRules(key='s_clean'))])
+
+    The rules are fixed when fitting, so the columns stay the same if rules
+    are added later.
+
+    Parameters
+    ----------
+    key : hashable, required
+        The key of the cleaned sentences in the data.
+    """
+
+    def __init__(self, key='s_clean'):
+        self.key = key
+
+    def fit(self, x, y=None):
+        self.rules_ = list(get_rules().names)
+        return self
+
+    def transform(self, data_dict):
+        return match_wordnik_rules_batch(data_dict[self.key], rules=self.rules_)
+
+
 # Stemming Utils
 stemmer = PorterStemmer()
 
@@ -16,8 +16,12 @@ __email__ = "manuel@1450.me"
 
 import os
 import codecs
+import hashlib
+from collections import OrderedDict
 from serapis.util import multiple_replace
 
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
 VARS = {
     "_DET_": r"\b(another|their|your|the|his|her|our|yer|my|an|a)\b ?",
     "_COPULA_": r"\b(ought to be|was usually|is usually|should be|was being|was to be|could be|has been|is being|is to be|might be|will be|were|are|was|is)\b ?",
@@ -73,16 +77,124 @@ patterns = {
 }
 
 
+def read_var_files():
+    """Returns the lexicon of every variable in VAR_FILES.
+
+    Returns:
+        dict -- maps variables to lists of tokens
+    """
+    lexicons = {}
+    for var, filename in VAR_FILES.items():
+        with codecs.open(os.path.join(CORPUS_PATH, filename), 'r', 'utf-8') as f:
+            lexicons[var] = f.read().splitlines()
+    return lexicons
+
+
+def checksum():
+    """Hash of everything compile() depends on, i.e. the patterns, variables
+    and lexicons. A precompiled bundle is stale if this has changed."""
+    md5 = hashlib.md5()
+    lexicons = read_var_files()
+    for key in sorted(patterns):
+        md5.update("{}\t{}\n".format(key, patterns[key]).encode('utf-8'))
+    for var in sorted(VARS):
+        md5.update("{}\t{}\n".format(var, VARS[var]).encode('utf-8'))
+    for var in sorted(lexicons):
+        md5.update("{}\t{}\n".format(var, "|".join(lexicons[var])).encode('utf-8'))
+    return md5.hexdigest()
+
+
+META_CHARACTERS = frozenset("\\.^$*+?{}[]()|")
+
+
+def _literal_prefix(token):
+    """Splits a lexicon entry (which may be a regular expression, e.g.
+    "term(?:ing|ed|s)?") into a prefix of plain characters and the rest.
+    Entries with a top-level "|" are not split at all."""
+    depth, escaped, in_class = 0, False, False
+    for char in token:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return "", token
+    length = 0
+    while length < len(token) and token[length] not in META_CHARACTERS:
+        length += 1
+    if length < len(token) and token[length] in "?*+{":
+        length -= 1  # The quantifier applies to the last plain character
+    return token[:length], token[length:]
+
+
+def _trie_regex(node):
+    """Turns a trie built by trie_alternation back into a regular expression."""
+    suffixes = node.get(None, [])
+    alternatives, leaves = [], []
+    for char in sorted(key for key in node if key is not None):
+        child = node[char]
+        if child == {None: [""]}:
+            leaves.append(char)
+        else:
+            alternatives.append(char + _trie_regex(child))
+    if len(leaves) == 1:
+        alternatives.append(leaves[0])
+    elif leaves:
+        alternatives.append("[{}]".format("".join("\\" + char if char in "\\]^-" else char for char in leaves)))
+    alternatives += [suffix for suffix in suffixes if suffix]
+    optional = "" in suffixes
+    if not alternatives:
+        return ""
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+    if len(alternatives) == 1 and (len(alternatives[0]) == 1 or alternatives[0] == "[{}]".format("".join(leaves))):
+        return alternatives[0] + "?"
+    return "(?:{}){}".format("|".join(alternatives), "?" if optional else "")
+
+
+def trie_alternation(tokens):
+    """Returns a regular expression that matches the same strings as
+    "|".join(tokens), but with common prefixes factored out, e.g.
+    ["the", "their", "these"] becomes "the(?:ir|se)?". The regex engine
+    then tries one branch per character instead of every token at every
+    position, so matching doesn't slow down as the lexicon grows.
+
+    Args:
+        tokens: list -- plain words or regular expressions
+    Returns:
+        str
+    """
+    trie = {}
+    for token in tokens:
+        prefix, rest = _literal_prefix(token)
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        suffixes = node.setdefault(None, [])
+        if rest not in suffixes:
+            suffixes.append(rest)
+    return _trie_regex(trie)
+
+
 def compile():
     """Loads variable substitutions from files and applies them to the
     patterns. Makes sure all patterns compile to regular expressions.
+
+    Returns:
+        OrderedDict -- maps rule names to regular expressions (as strings),
+                       in the iteration order of patterns
     """
-    for var, filename in VAR_FILES.items():
-        tokens = codecs.open(os.path.join("serapis/corpus", filename), 'r', 'utf-8').read().splitlines()
-        VARS[var] = r"\b({})\b ?".format("|".join(tokens))
+    variables = dict(VARS)
+    for var, tokens in read_var_files().items():
+        variables[var] = r"\b({})\b ?".format(trie_alternation(tokens))
 
     # Prepare patterns
-    for key, pattern in patterns.items():
-        patterns[key] = multiple_replace(pattern, VARS, re_style=True)
-
-    return patterns
+    return OrderedDict((key, multiple_replace(pattern, variables, re_style=True)) for key, pattern in patterns.items())
@@ -10,19 +10,25 @@ __email__ = "clare@summer.ai"
 
 
 import os
+import glob
 import logging
+import hashlib
 import shutil
 import zipfile
 import datetime
 import tempfile
 import json as json
+import numpy as np
+from scipy import sparse
 from contextlib import closing
 
 from serapis.util import get_git_hash
 from serapis.config import config
 from serapis.learning_utils import ItemSelector
+from serapis.scorer import LinearScorer
 
 from sklearn.externals import joblib
+from sklearn.externals.joblib import hash as joblib_hash
 from sklearn.metrics import precision_recall_fscore_support, roc_curve, auc
 
 log = logging.getLogger('serapis.persist_model')
@@ -38,6 +44,11 @@ model_zip_name = config.model_zip_name
 pipeline_filename = 'pipeline_' + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 pipeline_bucket = config.model_s3_bucket
 pipeline_zip_name = config.model_zip_name
+scorer_name = config.model_scorer_name
+
+# Training and test data live in a separate bundle that production never downloads
+evaluation_zip_name = config.model_evaluation_zip_name
+EVALUATION_DATA = ('x_train', 'y_train', 'x_test', 'y_test')
 
 
 def vectorizer_to_str(obj):
@@ -47,6 +58,136 @@ def vectorizer_to_str(obj):
     return str(clean_dict)
 
 
+def block_fingerprint(block):
+    """
+    Content hash of a fitted feature union block, e.g.
+    ItemSelector -> TfidfVectorizer -> SelectKBest. joblib.hash takes seconds
+    on large vocabularies, so those are hashed as a single joined string.
+
+    Returns:
+        str
+    """
+    md5 = hashlib.md5()
+    for name, step in getattr(block, 'steps', [('', block)]):
+        state = dict(vars(step))
+        for attr in ('vocabulary_', 'stop_words_'):
+            tokens = state.pop(attr, None)
+            if tokens:
+                md5.update("\n".join(sorted(tokens, key=tokens.get) if attr == 'vocabulary_' else sorted(tokens)).encode('utf-8'))
+        md5.update(joblib_hash((name, type(step).__name__, state)))
+    return md5.hexdigest()
+
+
+def write_bundle(archive_name, objects, metadata, mmap=False):
+    """
+    Dumps objects with joblib and packs them into a zip archive together
+    with metadata.json.
+
+    Args:
+        archive_name: str
+        objects: dict -- maps names to objects, each is stored as <name>.bin
+                 (plus the .npy files joblib writes alongside it)
+        metadata: dict
+        mmap: bool -- If True, store everything uncompressed so that
+              from_file can memory-map the numpy arrays instead of
+              decompressing and copying them into every process.
+    Returns:
+        str -- archive_name
+    """
+    compress, compression = (0, zipfile.ZIP_STORED) if mmap else (9, zipfile.ZIP_DEFLATED)
+    staging_dir = tempfile.mkdtemp()
+    try:
+        # joblib requires dump to disk
+        ItemSelector('temp')  # need to load ItemSelector alongside
+        filenames = []
+        for name, obj in objects.items():
+            # Uncompressed, older joblib versions write numpy arrays to <name>.bin_NN.npy next to <name>.bin
+            written = joblib.dump(obj, os.path.join(staging_dir, name + '.bin'), compress=compress)
+            filenames.extend(os.path.basename(fn) for fn in written)
+
+        with open(os.path.join(staging_dir, 'metadata.json'), 'wt') as f:
+            f.write(json.dumps(metadata))
+        filenames.append('metadata.json')
+
+        with closing(zipfile.ZipFile(archive_name, 'w', compression)) as zfile:
+            for fn in filenames:
+                zfile.write(os.path.join(staging_dir, fn), fn)
+    finally:
+        shutil.rmtree(staging_dir)
+    return archive_name
+
+
+def extract_bundle(zfile, directory, names):
+    """Extracts metadata.json and <name>.bin (with the .npy files joblib
+    wrote alongside it) for each of names, skipping everything else (e.g.
+    training data in archives made before the split)."""
+    wanted = set(name + '.bin' for name in names) | {'metadata.json'}
+    sidecars = tuple(name + '.bin_' for name in names)
+    for member in zfile.namelist():
+        if member in wanted or member.startswith(sidecars):
+            zfile.extract(member, directory)
+
+
+def read_bundle(directory, names, mmap_mode=None):
+    """Loads metadata.json and <name>.bin for each of names from an
+    unpacked archive.
+
+    Args:
+        directory: str
+        names: iterable
+        mmap_mode: str -- passed to joblib.load
+    Returns:
+        dict
+    """
+    data = {}
+    for filename in os.listdir(directory):
+        filename_full = os.path.join(directory, filename)
+        if filename == 'metadata.json':
+            data['metadata'] = json.loads(open(filename_full, 'rt').read())
+        elif filename.endswith('.bin') and filename[:-4] in names:
+            data[filename[:-4]] = joblib.load(filename_full, mmap_mode=mmap_mode)
+    return data
+
+
+def upload_bundle(archive_name, bucket, key):
+    """Uploads an archive to S3"""
+    try:
+        obj = config.s3.Object(bucket_name=bucket, key=key)
+        obj.put(Body=open(archive_name, 'rb'))
+    except Exception, e:
+        message = "Something went wrong pushing the zip to s3: %s %s" % (e, type(e))
+        log.warning(message)
+        raise Exception(message)
+
+
+def load_evaluation_data(f):
+    """Loads training and test data from an evaluation bundle.
+
+    Returns:
+        dict -- with keys x_train, y_train, x_test, y_test and metadata
+    """
+    zfile = zipfile.ZipFile(f)
+    extract_dir = tempfile.mkdtemp()
+    try:
+        extract_bundle(zfile, extract_dir, EVALUATION_DATA)
+        return read_bundle(extract_dir, EVALUATION_DATA)
+    finally:
+        shutil.rmtree(extract_dir)
+
+
+def get_evaluation_data(bucket=pipeline_bucket, key=evaluation_zip_name):
+    """Retrieves the evaluation bundle from s3. Only needed for training
+    and evaluation, never in production."""
+    filename = os.path.join(local_path, key)
+    try:
+        config.s3_client.download_file(bucket, key, filename)
+    except Exception, e:
+        message = "Something went wrong pulling from s3: %s %s" % (e, type(e))
+        log.warning(message)
+        raise Exception(message)
+    return load_evaluation_data(filename)
+
+
 class PackagedModel(object):
     """
     Package an model with a vectorizer for a predictive package.
@@ -59,10 +200,15 @@ class PackagedModel(object):
     Stores to local directory and S3
     Model identified by `model_bucket` attr
 
+    The serving bundle only holds the vectorizer, model and metadata; training
+    and test data go into a separate evaluation bundle (see get_evaluation_data).
+
     NB: Does _not_ employ versioning, assumes single model (identified by s3 bucket)
 
     """
 
+    SERVING = ('vectorizer', 'model')
+
     @classmethod
     def get_model(cls, model_bucket=model_bucket):
         """Retrieve the model from s3"""
@@ -81,15 +227,8 @@ class PackagedModel(object):
         zfile = zipfile.ZipFile(f)
         extract_dir = tempfile.mkdtemp()
         try:
-            zfile.extractall(extract_dir)
-            data = {}
-            for filename in zfile.namelist():
-                filename_full = os.path.join(extract_dir, filename)
-                if filename == 'metadata.json':
-                    data['metadata'] = json.loads(open(filename_full, 'rt').read())
-                else:
-                    data[filename[:-4]] = joblib.load(filename_full)
-            return PackagedModel(**data)
+            extract_bundle(zfile, extract_dir, cls.SERVING)
+            return PackagedModel(**read_bundle(extract_dir, cls.SERVING))
         finally:
             shutil.rmtree(extract_dir)
 
@@ -106,37 +245,24 @@ class PackagedModel(object):
         No versioning employed in S3.
 
         """
-        filename += '.zip'
-
         try:
             os.makedirs(local_path)
         except OSError:  # directory exists, so we can use it
             pass
 
-        archive_name = os.path.join(local_path, filename)
-        # joblib requires dump to disk
-        joblib.dump(self._vectorizer, os.path.join(local_path, 'vectorizer.bin'), compress=9)
-        joblib.dump(self._model, os.path.join(local_path, 'model.bin'), compress=9)
-        joblib.dump(self._data['x_train'], os.path.join(local_path, 'x_train.bin'), compress=9)
-        joblib.dump(self._data['y_train'], os.path.join(local_path, 'y_train.bin'), compress=9)
-        joblib.dump(self._data['x_test'], os.path.join(local_path, 'x_test.bin'), compress=9)
-        joblib.dump(self._data['y_test'], os.path.join(local_path, 'y_test.bin'), compress=9)
-
-        with open(os.path.join(local_path, 'metadata.json'), 'wt') as f:
-            f.write(json.dumps(self.metadata))
-
-        with closing(zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED)) as zfile:
-            for fn in ['vectorizer.bin', 'model.bin', 'x_train.bin', 'y_train.bin',
-                       'x_test.bin', 'y_test.bin', 'metadata.json']:
-                zfile.write(os.path.join(local_path, fn), fn)
-        # Upload zipped file to S3
-        try:
-            obj = config.s3.Object(bucket_name=model_bucket, key=model_zip_name)
-            obj.put(Body=open(archive_name, 'rb'))
-        except Exception, e:
-            message = "Something went wrong pushing the zip to s3: %s %s" % (e, type(e))
-            log.warning(message)
-            raise Exception(message)
+        archive_name = write_bundle(
+            os.path.join(local_path, filename + '.zip'),
+            {'vectorizer': self._vectorizer, 'model': self._model},
+            self.metadata
+        )
+        evaluation_name = write_bundle(
+            os.path.join(local_path, filename + '.evaluation.zip'),
+            {k: self._data[k] for k in EVALUATION_DATA},
+            self.metadata
+        )
+        # Upload zipped files to S3
+        upload_bundle(archive_name, model_bucket, model_zip_name)
+        upload_bundle(evaluation_name, model_bucket, evaluation_zip_name)
 
     def __init__(
         self,
@@ -150,12 +276,13 @@ class PackagedModel(object):
             self._model = model
             self._data = {
                 'x_train': x_train,
-                'x_train_vec': vectorizer.fit_transform(x_test),
                 'y_train': y_train,
                 'x_test': x_test,
-                'x_test_vec': vectorizer.transform(x_test),
                 'y_test': y_test,
             }
+            if x_test is not None:  # Not available when loaded from a serving bundle
+                self._data['x_train_vec'] = vectorizer.fit_transform(x_test)
+                self._data['x_test_vec'] = vectorizer.transform(x_test)
             now = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 
             if metadata:
@@ -194,12 +321,18 @@ class PackagedPipeline(object):
     Stores to local directory and S3
     Pipeline identified by `pipeline_bucket` attr
 
+    The serving bundle only holds the pipeline, feature union and metadata;
+    training and test data go into a separate evaluation bundle (see
+    get_evaluation_data).
+
     NB: Does _not_ employ versioning, assumes single pipeline (identified by s3 bucket)
         Requires pipeline with Feature Translation with key='union'
         Requires input data: 's_clean', 'pos'
 
     """
 
+    SERVING = ('pipeline', 'feature_union')
+
     @classmethod
     def get(cls, pipeline_bucket=pipeline_bucket):
         """Retrieve the pipeline from s3"""
@@ -221,67 +354,164 @@ class PackagedPipeline(object):
 
     @classmethod
     def from_file(cls, f):
-        """Given filename, read file and load pipeline"""
+        """Given filename, read file and load pipeline.
+
+        Archives written with `mmap=True` are unpacked once next to the archive
+        and memory-mapped, everything else is unpacked to a temporary directory.
+        """
         zfile = zipfile.ZipFile(f)
+        if all(info.compress_type == zipfile.ZIP_STORED for info in zfile.infolist()):
+            return cls.from_directory(cls._unpack(zfile, f), mmap_mode='r')
         extract_dir = tempfile.mkdtemp()
         try:
-            zfile.extractall(extract_dir)
-            data = {}
-            for filename in zfile.namelist():
-                filename_full = os.path.join(extract_dir, filename)
-                if filename == 'metadata.json':
-                    data['metadata'] = json.loads(open(filename_full, 'rt').read())
-                else:
-                    data[filename[:-4]] = joblib.load(filename_full)
-            return PackagedPipeline(**data)
+            extract_bundle(zfile, extract_dir, cls.SERVING)
+            return cls.from_directory(extract_dir)
         finally:
             shutil.rmtree(extract_dir)
 
-    def save(self, pipeline_bucket=pipeline_bucket, filename=pipeline_filename):
+    @classmethod
+    def from_directory(cls, directory, mmap_mode=None):
+        """Loads a pipeline from an unpacked archive.
+
+        Args:
+            directory: str
+            mmap_mode: str -- passed to joblib.load. With 'r', numpy arrays
+                       (idf vectors, feature scores, log probabilities) are
+                       mapped read-only from disk and the pages are shared
+                       between all processes loading the same directory.
+        """
+        return PackagedPipeline(**read_bundle(directory, cls.SERVING, mmap_mode=mmap_mode))
+
+    @classmethod
+    def _unpack(cls, zfile, f):
+        """Unpacks an archive to a directory that stays around as long as the
+        archive doesn't change, so other processes can map the same files.
+        Directories unpacked from older versions of the archive are removed;
+        processes that still map their files keep them until they unmap."""
+        base = os.path.splitext(f)[0]
+        version = int(os.path.getmtime(f) * 1000)
+        target = "%s.%d" % (base, version)
+        if not os.path.isdir(target):
+            extract_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(f)))
+            extract_bundle(zfile, extract_dir, cls.SERVING)
+            try:
+                os.rename(extract_dir, target)
+            except OSError:  # Another process was faster
+                shutil.rmtree(extract_dir)
+            else:
+                for directory in glob.glob(base + ".*"):
+                    suffix = directory[len(base) + 1:]
+                    if suffix.isdigit() and int(suffix) < version and os.path.isdir(directory):
+                        shutil.rmtree(directory, ignore_errors=True)
+        return target
+
+    def pack(self, archive_name, mmap=False):
+        """
+        Writes the serving bundle (pipeline, feature union and metadata) to a
+        zip archive.
+
+        Args:
+            archive_name: str
+            mmap: bool -- If True, store everything uncompressed so that
+                  from_file can memory-map the numpy arrays.
+        """
+        return write_bundle(archive_name, {'pipeline': self._pipeline, 'feature_union': self._feature_union},
+                            self.metadata, mmap=mmap)
+
+    def export_scorer(self, filename):
+        """Compiles the pipeline into a LinearScorer that only needs numpy
+        and writes it to filename (see serapis.scorer)."""
+        return LinearScorer.from_pipeline(self).save(filename)
+
+    @property
+    def classes_(self):
+        return self._pipeline.classes_
+
+    def block_fingerprints(self):
+        """Content hashes of the fitted blocks of the feature union. Two
+        pipelines whose blocks have the same fingerprint produce the same
+        features, so the block only needs to be transformed once.
+
+        Returns:
+            list -- (fingerprint, transformer, weight) tuples
+        """
+        if getattr(self, '_fingerprints', None) is None:
+            weights = self._feature_union.transformer_weights or {}
+            self._fingerprints = [
+                (block_fingerprint(transformer), transformer, weights.get(name))
+                for name, transformer in self._feature_union.transformer_list
+                if transformer is not None
+            ]
+        return self._fingerprints
+
+    def transform(self, data, cache=None):
+        """Same as feature_union.transform(data), but reuses block outputs
+        from cache and stores its own there.
+
+        Args:
+            data: dict -- e.g. {'s_clean': [...], 'pos': [...]}
+            cache: dict -- maps block fingerprints to transformed features.
+                   Share it between pipelines scoring the same data.
+        """
+        if cache is None:
+            return self._feature_union.transform(data)
+        blocks = []
+        for fingerprint, transformer, weight in self.block_fingerprints():
+            if fingerprint not in cache:
+                cache[fingerprint] = transformer.transform(data)
+            blocks.append(cache[fingerprint] if weight is None else cache[fingerprint] * weight)
+        if any(sparse.issparse(block) for block in blocks):
+            return sparse.hstack(blocks).tocsr()
+        return np.hstack(blocks)
+
+    def predict_proba(self, data, cache=None):
+        """Class probabilities for raw input data.
+
+        Args:
+            data: dict -- e.g. {'s_clean': [...], 'pos': [...]}
+            cache: dict -- shared feature cache, see transform
+        Returns:
+            np.ndarray -- (n_samples, n_classes)
+        """
+        return self._pipeline.predict_proba(self.transform(data, cache))
+
+    def pack_evaluation(self, archive_name):
+        """Writes training and test data to a zip archive."""
+        return write_bundle(archive_name, {k: self._data[k] for k in EVALUATION_DATA}, self.metadata)
+
+    def save(self, pipeline_bucket=pipeline_bucket, filename=pipeline_filename, mmap=False):
         """
         Save the classifier under current path
 
         - Checks if dir exists
         - Saves files to disk (per joblib)
-        - Packs files into zip archive
+        - Packs serving and evaluation files into separate zip archives
+        - Compiles the dependency-free scorer, if the pipeline allows it
         - Saves to s3 bucket
 
         Replaces a single pipeline in S3. Local pipeline have datetime stamps.
         No versioning employed in S3.
 
+        Args:
+            mmap: bool -- write the uncompressed, memory-mappable layout (see pack)
         """
-        filename += '.zip'
-
         try:
             os.makedirs(local_path)
         except OSError:  # directory exists, so we can use it
             pass
 
-        archive_name = os.path.join(local_path, filename)
-        # joblib requires dump to disk
-        ItemSelector('temp')  # need to load ItemSelector alongside
-        joblib.dump(self._pipeline, os.path.join(local_path, 'pipeline.bin'), compress=9)
-        joblib.dump(self._feature_union, os.path.join(local_path, 'feature_union.bin'), compress=9)
-        joblib.dump(self._data['x_train'], os.path.join(local_path, 'x_train.bin'), compress=9)
-        joblib.dump(self._data['y_train'], os.path.join(local_path, 'y_train.bin'), compress=9)
-        joblib.dump(self._data['x_test'], os.path.join(local_path, 'x_test.bin'), compress=9)
-        joblib.dump(self._data['y_test'], os.path.join(local_path, 'y_test.bin'), compress=9)
-
-        with open(os.path.join(local_path, 'metadata.json'), 'wt') as f:
-            f.write(json.dumps(self.metadata))
-
-        with closing(zipfile.ZipFile(archive_name, 'w', zipfile.ZIP_DEFLATED)) as zfile:
-            for fn in ['pipeline.bin', 'feature_union.bin', 'x_train.bin', 'y_train.bin',
-                       'x_test.bin', 'y_test.bin', 'metadata.json']:
-                zfile.write(os.path.join(local_path, fn), fn)
-        # Upload zipped file to S3
+        archive_name = self.pack(os.path.join(local_path, filename + '.zip'), mmap=mmap)
+        evaluation_name = self.pack_evaluation(os.path.join(local_path, filename + '.evaluation.zip'))
         try:
-            obj = config.s3.Object(bucket_name=pipeline_bucket, key=pipeline_zip_name)
-            obj.put(Body=open(archive_name, 'rb'))
-        except Exception, e:
-            message = "Something went wrong pushing the zip to s3: %s %s" % (e, type(e))
-            log.warning(message)
-            raise Exception(message)
+            scorer_filename = self.export_scorer(os.path.join(local_path, filename + '.npz'))
+        except ValueError, e:
+            log.warning("Pipeline can't be compiled into a scorer: %s" % e)
+            scorer_filename = None
+        # Upload zipped files to S3
+        upload_bundle(archive_name, pipeline_bucket, pipeline_zip_name)
+        upload_bundle(evaluation_name, pipeline_bucket, evaluation_zip_name)
+        if scorer_filename:
+            upload_bundle(scorer_filename, pipeline_bucket, scorer_name)
 
     def __init__(
         self,
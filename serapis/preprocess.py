@@ -15,12 +15,23 @@ __date__ = "2015-11-30"
 __email__ = "manuel@summer.ai"
 
 from unidecode import unidecode
-from serapis.util import squashed, multiple_replace
-from nltk.tokenize import sent_tokenize
+from bisect import bisect_left
+from collections import deque
+from itertools import izip
+import multiprocessing
+from serapis.util import squashed, batch
+from serapis.segment import segmenter
 import re
 
 QUOTES_RE = "|".join(("&quot;", "“", "«", "&laquo;", "‹", "&lsaquo;", "„", "&bdquo;", "‚", "&sbquo;", "”", "&rdquo;", "&rsquo;", "»", "&raquo;", "›", "&rsaquo;", "“", "&ldquo;", "&lsquo;"))
 
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]+")
+QUALIFY_BAD_CHARS_RE = re.compile(r"[█,!?:0-9]")
+ASCII_LETTER_RE = re.compile(r"[a-zA-Z]")
+HIGH_CHARACTER_RE = re.compile(r"[^\x00-\xff]")
+MARKUP_RE = re.compile(r"<[^>]{1,20}>|&[a-z]+;")
+NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
 # This is for detecting dates in Strings
 months = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
 short_months = [mo[:3] for mo in months]
@@ -29,16 +40,190 @@ time_re = "(,? \d+: ?\d+(: ?\d+)?( [aApP][mM])?( \([a-zA-Z]+\))?)?"
 date_re_1 = "\d{1,2}/\d{1,2}/\d{2,4}"
 date_re_2 = "({}) \d+,? \d*".format(all_months)
 DATE_RE = "({}|{})( \([a-zA-Z]+\))?{}".format(date_re_1, date_re_2, time_re)
+DATE_PATTERN = re.compile(DATE_RE, re.IGNORECASE)
+DIGIT_RE = re.compile(r"\d")
+
+# Rewrites of preprocess_sentence
+TAG_RE = re.compile(r"<[^>]{1,20}>")
+SPACE_BEFORE_RE = re.compile(r"([^ ])([\(\[\"])")  # Give brackets space to breathe
+SPACE_AFTER_RE = re.compile(r"([\)\]\"\!\?:])([^ ])")
+QUOTES_PATTERN = re.compile(QUOTES_RE)
+WIKTIONARY_POS_RE = re.compile(r"^ *\([a-zA-Z ]+\) *", re.IGNORECASE)
 
 # UTILITIES
 ########################
 
 
 def _strip_dates(sentence):
-    dates = list(re.finditer(DATE_RE, sentence, re.IGNORECASE))
-    if not dates:
+    if not DIGIT_RE.search(sentence):  # All dates contain digits
         return sentence
-    return sentence[dates[-1].end():].lstrip(") ")
+    last = None
+    for last in DATE_PATTERN.finditer(sentence):
+        pass
+    if last is None:
+        return sentence
+    return sentence[last.end():].lstrip(") ")
+
+
+class TermContext(object):
+    """
+    Holds everything about a term that preprocessing a sentence needs, so
+    the regular expressions are compiled once per term and page instead of
+    once per sentence:
+
+    >>> context = TermContext("Déjà Vu")
+    >>> for sentence in paragraph_to_sentences(paragraph, context):
+    >>>     s_clean, variants = clean_sentence(sentence, context)
+
+    All functions that take a term also take a TermContext.
+
+    Properties:
+        term: str
+        squashed: str -- squashed term, e.g. 'dejavu'
+        wiktionary_re: regex -- finds Wiktionary's "Rate this definition: term"
+        pos_suffix_re: regex -- finds "term (noun)" etc.
+        variant_re: regex -- finds spelling variants in normalized text, see
+                    normalize
+    """
+
+    def __init__(self, term):
+        self.term = term
+        self.squashed = squashed(term)
+        self.wiktionary_re = re.compile("Rate this definition: {}".format(term), re.IGNORECASE)
+        self.pos_suffix_re = re.compile(r"{} \((noun|verb|adj|adjective|adv|adverb)\)".format(term), re.IGNORECASE)
+        if not self.squashed:  # Terms like "--" have no letters to find, so nothing matches
+            self.variant_re = re.compile(r'(?!)')
+            return
+        # This RE allows for up to one non-letter character between all letters
+        fuzzy_term = ''.join("{}[^a-z0-9]?".format(c) for c in self.squashed[:-1]) + self.squashed[-1]
+        self.variant_re = re.compile(r'\b({})s?\b'.format(fuzzy_term))  # s? for plurals
+
+    def may_contain(self, text):
+        """Cheap check whether text can contain the term, without tokenizing
+        it: the squashed term has to occur in the squashed text (see
+        util.squashed), either as it is or with tags and HTML entities removed
+        like preprocess_sentence does. Both are needed, since a "<...>" match
+        in the whole text can span several sentences.
+
+        Returns:
+            bool -- False only if no sentence of the text has a variant
+        """
+        if not self.squashed:
+            return False
+        if NON_ASCII_RE.search(text):  # Only transliterate what isn't ASCII yet
+            text = NON_ASCII_RE.sub(lambda m: unidecode(m.group(0)), text)
+        text = text.lower()
+        return self.squashed in NON_ALNUM_RE.sub("", text) or self.squashed in NON_ALNUM_RE.sub("", MARKUP_RE.sub("", text))
+
+
+def _context(term):
+    return term if isinstance(term, TermContext) else TermContext(term)
+
+
+def normalize(text):
+    """Transliterates text to lowercase ASCII, like unidecode(text).lower(),
+    and keeps track of where each character came from.
+
+    Args:
+        text: str
+    Returns:
+        tuple -- normalized text and a list with the index in text of every
+                 character of the normalized text (None if text is ASCII,
+                 ie. the indices are the same)
+    """
+    if not NON_ASCII_RE.search(text):
+        return text.lower(), None
+    parts, origins, position = [], [], 0
+    for m in NON_ASCII_RE.finditer(text):
+        parts.append(text[position:m.start()])
+        origins.extend(xrange(position, m.start()))
+        for idx in xrange(m.start(), m.end()):
+            decoded = unidecode(text[idx])
+            parts.append(decoded)
+            origins.extend([idx] * len(decoded))
+        position = m.end()
+    parts.append(text[position:])
+    origins.extend(xrange(position, len(text)))
+    return "".join(parts).lower(), origins
+
+
+class VariantScan(object):
+    """
+    Finds all spelling variants of a term in a whole document at once, so
+    that sentences can be cleaned by slicing:
+
+    >>> doc = " ".join(sentences)
+    >>> scan = VariantScan(doc, context)
+    >>> scan.clean(0, len(sentences[0]))  # Same as clean_sentence(sentences[0], context)
+
+    The document is normalized once (see normalize) and the positions of
+    variants are mapped back to the original text, so they are right even
+    where transliteration changes the length of the text (e.g. "ß" -> "ss").
+
+    Cleaning a sentence replaces every occurrence of the variants found in
+    it, including inside longer words ("nofollowed" -> "_TERM_ed"). These
+    occurrences are found in a second pass over the document.
+
+    Properties:
+        text: str
+        spans: list -- (start, end) of every variant in text, in order
+        occurrences: list -- (start, end) of every occurrence of any
+                     variant in text, in order
+    """
+
+    def __init__(self, text, term):
+        """
+        Args:
+            text: str
+            term: str or TermContext
+        """
+        context = _context(term)
+        self.text = text
+        normalized, origins = normalize(text)
+        strip_plural = not context.term.lower().endswith("s")
+        self.spans = []
+        for m in context.variant_re.finditer(normalized):
+            start, end = m.span() if origins is None else (origins[m.start()], origins[m.end() - 1] + 1)
+            if strip_plural and text[end - 1] in "sS":
+                end -= 1
+            self.spans.append((start, end))
+        self.occurrences = []
+        variants = set(text[start:end] for start, end in self.spans)
+        if variants:
+            variants_re = re.compile('|'.join(map(re.escape, sorted(variants, key=len, reverse=True))))
+            self.occurrences = [m.span() for m in variants_re.finditer(text)]
+
+    def _within(self, spans, start, end):
+        end = len(self.text) if end is None else end
+        for span_start, span_end in spans[bisect_left(spans, (start, start)):]:
+            if span_end > end:
+                break
+            yield span_start, span_end
+
+    def variants(self, start=0, end=None):
+        """
+        Returns:
+            set -- all variants in text[start:end]
+        """
+        return set(self.text[span_start:span_end] for span_start, span_end in self._within(self.spans, start, end))
+
+    def clean(self, start=0, end=None, replacement="_TERM_"):
+        """Replaces all variants in text[start:end] with a replacement.
+
+        Returns:
+            tuple -- the cleaned text and all variants found
+        """
+        end = len(self.text) if end is None else end
+        variants = self.variants(start, end)
+        parts, position = [], start
+        for span_start, span_end in self._within(self.occurrences, start, end):
+            if self.text[span_start:span_end] in variants:
+                parts.append(self.text[position:span_start])
+                parts.append(replacement)
+                position = span_end
+        parts.append(self.text[position:end])
+        return "".join(parts), variants
+
 
 # WORDS
 ########################
@@ -52,33 +237,32 @@ def qualify_term(term):
     """
     # Comments are how many disqualified words out of 10k the rule caught
     # Ordered it in descending order (fast failure mode)
-    if any(len(word) > 15 for word in term.split()):
-        return False
-    if len(term.split()) > 5:  # 28%
-        return False
-    if any(c in term for c in "█,!?:"):  # 18%
-        return False
-    if sum(ord(c) > 255 for c in term) > 2:  # 0.8%
+    if QUALIFY_BAD_CHARS_RE.search(term):  # 18%, and no numbers
         return False
-
     parts = term.split()
-    short_parts = sum([len(w) < 3 for w in parts])
-    if short_parts == len(parts):
+    if len(parts) > 5:  # 28%
         return False
-    if any(len(part) == 1 and part != 'a' for part in parts):
+    short_parts = 0
+    for part in parts:
+        if len(part) > 15 or (len(part) == 1 and part != 'a'):
+            return False
+        short_parts += len(part) < 3
+    if short_parts == len(parts):
         return False
     if len(parts) > 2 and short_parts >= len(parts) - 1:
         return False
-    if re.search("\d", term):
-        return False  # No numbers
-    num_letters = len(re.findall("[a-zA-Z]", term))
+    num_letters = len(ASCII_LETTER_RE.findall(term))
     if num_letters < len(term) / 2 or num_letters < 3:
         return False
+    if num_letters == len(term) - term.count(" "):
+        return True  # Only ASCII letters and spaces
+
+    if len(HIGH_CHARACTER_RE.findall(term)) > 2:  # 0.8%
+        return False
     decoded = unidecode(term)
-    try:
-        unicode_letters = len(term) - sum(term[n] == decoded[n] for n in range(len(term)))
-    except IndexError:
+    if len(decoded) < len(term):
         return False
+    unicode_letters = len(term) - sum(a == b for a, b in izip(term, decoded))
     if unicode_letters > len(term) / 2:
         return False
     return True
@@ -132,46 +316,99 @@ def clean_and_qualify_term(term):
 # List of words
 ###############
 
-def clean_and_qualify_wordlist(wordlist):
+def clean_and_qualify_wordlist(wordlist, processes=1, chunksize=1000):
     """Generator that returns cleaned version of a list of words.
-    Will remove any non-words.
+    Will remove any non-words. Of words that squash to the same string, only
+    the first one is returned.
+
+    With processes > 1, words are cleaned in a pool of worker processes,
+    chunksize words at a time. At most two chunks per process are in flight,
+    so wordlist can be a generator over a file that doesn't fit into memory,
+    and words come out in the same order as without workers.
 
     Args:
-        wordlist: list
+        wordlist: list or generator
+        processes: int
+        chunksize: int
     Returns:
-        list
+        generator
     """
-    cleaned = filter(bool, map(clean_and_qualify_term, wordlist))
-    cleaned_squashed = set()
-    for term in cleaned:
-        s = squashed(term)
-        if s not in cleaned_squashed:
-            cleaned_squashed.add(s)
-            yield term
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        cleaned_squashed = set()
+        for chunk in _cleaned_chunks(wordlist, pool, processes, chunksize):
+            for term, s in chunk:
+                if s not in cleaned_squashed:
+                    cleaned_squashed.add(s)
+                    yield term
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def _cleaned_chunks(wordlist, pool, processes, chunksize):
+    if not pool:
+        for chunk in batch(wordlist, chunksize):
+            yield _clean_chunk(chunk)
+        return
+    pending = deque()
+    for chunk in batch(wordlist, chunksize):
+        pending.append(pool.apply_async(_clean_chunk, (chunk, )))
+        if len(pending) >= 2 * processes:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _clean_chunk(words):
+    """Returns (cleaned, squashed) for all words that qualify."""
+    result = []
+    for word in words:
+        cleaned = clean_and_qualify_term(word)
+        if cleaned:
+            result.append((cleaned, squashed(cleaned)))
+    return result
 
 
 # Paragraphs
 ########################
 
-def paragraph_to_sentences(paragraph, term):
+def paragraphs_to_sentences(paragraphs, term):
     """
-    Turns a paragraph into clean, preprocessed sentences
+    Turns paragraphs into clean, preprocessed sentences. The sentences are
+    sliced from the offsets of the sentence segmenter, which tokenizes each
+    paragraph on its own (see segment.SentenceSegmenter.segment).
+
+    Args:
+        paragraphs: list -- str
+        term: str or TermContext
+    Returns:
+        list -- list of sentences for each paragraph
     """
+    context = _context(term)
     result = []
-    paragraph = re.sub(r"([^ ])([\(\[\"])", r"\1 \2", paragraph)  # Give brackets space to breathe
-    paragraph = re.sub(r"([\)\]\"\!\?:])([^ ])", r"\1 \2", paragraph)
-    paragraph = re.sub(r"([^. ]{3})\.([^. ]{3}|A |An )", r"\1. \2", paragraph)
-    paragraph = re.sub(r" e\.?g\.? ", " _eg_ ", paragraph)  # sent_tokenize improperly splits sentences here
-    paragraph = re.sub(r" i\.?e\.? ", " _ie_ ", paragraph)
-    sentences = sent_tokenize(paragraph)
-    for sentence in sentences:
-        sentence = sentence.replace("_eg_", "_e.g._").replace("_ie_", "i.e.")  # reverts edge case
-        processed = preprocess_sentence(sentence, term)
-        if qualify_sentence(processed):
-            result.append(processed)
+    for text, spans in segmenter.segment(paragraphs):
+        sentences = []
+        for start, end in spans:
+            sentence = text[start:end].replace("_eg_", "_e.g._").replace("_ie_", "i.e.")  # reverts edge case
+            processed = preprocess_sentence(sentence, context)
+            if qualify_sentence(processed):
+                sentences.append(processed)
+        result.append(sentences)
     return result
 
 
+def paragraph_to_sentences(paragraph, term):
+    """
+    Turns a paragraph into clean, preprocessed sentences
+
+    Args:
+        paragraph: str
+        term: str or TermContext
+    """
+    return paragraphs_to_sentences([paragraph], term)[0]
+
+
 # Sentences
 ########################
 
@@ -184,20 +421,23 @@ def preprocess_sentence(sentence, term):
 
     Args:
         sentence: str
-        term: str
+        term: str or TermContext
     """
-    sentence = re.sub("<[^>]{1,20}>", " ", sentence)  # Strip tags
+    context = _context(term)
+    if "<" in sentence:
+        sentence = TAG_RE.sub(" ", sentence)  # Strip tags
     sentence = _strip_dates(sentence)  # If there are dates in the sentence, start right of those
     sentence = sentence.strip(" *#>[]1234567890").replace("\n", " ").replace("_", " ").replace("’", "'")
-    sentence = re.sub(r"([^ ])([\(\[\"])", r"\1 \2", sentence)  # Give brackets space to breathe
-    sentence = re.sub(r"([\)\]\"\!\?:])([^ ])", r"\1 \2", sentence)
-    sentence = re.sub(QUOTES_RE, '"', sentence)  # Normalise quotes
+    sentence = SPACE_BEFORE_RE.sub(r"\1 \2", sentence)
+    sentence = SPACE_AFTER_RE.sub(r"\1 \2", sentence)
+    if "&" in sentence or NON_ASCII_RE.search(sentence):  # All quotes to normalise are entities or non-ASCII
+        sentence = QUOTES_PATTERN.sub('"', sentence)
     sentence = " ".join(sentence.split())  # Normalise whitespace
     # This is specific to Wiktionary
-    m = re.search("Rate this definition: {}".format(term), sentence, re.IGNORECASE) or re.search(r"{} \((noun|verb|adj|adjective|adv|adverb)\)".format(term), sentence, re.IGNORECASE)
+    m = context.wiktionary_re.search(sentence) or context.pos_suffix_re.search(sentence)
     if m:
-        sentence = re.sub(r"^ *\([a-zA-Z ]+\) *", "", sentence[m.end():], flags=re.IGNORECASE)
-        sentence = "{}: {}".format(term, sentence)
+        sentence = WIKTIONARY_POS_RE.sub("", sentence[m.end():])
+        sentence = "{}: {}".format(context.term, sentence)
 
     # This if for urban Dictionary:
     if sentence.startswith("Top Definition "):
@@ -217,27 +457,14 @@ def collect_variants(text, term, replace="_TERM_"):
 
     Args:
         text: str -- text in which to search for spelling variants
-        term: str
+        term: str or TermContext
     Returns:
         set -- A set of all variants found.
 
     *NB: This is used in the output JSON as an additional index within Wordnik #TODO
 
     """
-    squashed_term = squashed(term)
-    clean_text = unidecode(text).lower()
-    # This RE allows for up to one non-letter character between all letters
-    fuzzy_term = ''.join("{}[^a-z0-9]?".format(c) for c in squashed_term[:-1]) + squashed_term[-1]
-    term_re = r'\b({})s?\b'.format(fuzzy_term)  # s? for plurals
-    collected = set()
-    for m in re.finditer(term_re, clean_text):
-        variant = text[m.start():m.end()]
-        if variant.lower().endswith("s") and not term.lower().endswith("s"):
-            variant = variant[:-1]
-        collected.add(variant)
-        # collected.add(term + 's')  # account for finding plurals
-        # collected.add(term + 'es')
-    return collected
+    return VariantScan(text, term).variants()
 
 
 def clean_sentence(sentence, term, replacement='_TERM_'):
@@ -251,14 +478,12 @@ def clean_sentence(sentence, term, replacement='_TERM_'):
 
     Args:
         sentence: str
-        term: str
+        term: str or TermContext
         replacement: str
     Returns:
         tuple -- Contains the cleaned sentence and all variants found.
     """
-    variants = collect_variants(sentence, term)
-    s_clean = multiple_replace(sentence, {v: replacement for v in variants}) if variants else sentence
-    return s_clean, variants
+    return VariantScan(sentence, term).clean(replacement=replacement)
 
 
 def qualify_sentence(p):
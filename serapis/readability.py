@@ -13,20 +13,23 @@ __email__ = "manuel@summer.ai"
 
 import math
 from unidecode import unidecode
-from nltk import sent_tokenize, word_tokenize
+from nltk import word_tokenize
+from serapis.segment import segmenter
 
 
 class Readability(object):
     """
     This class computes various Readability metrics on documents.
     """
-    def __init__(self, doc):
+    def __init__(self, doc, sentence_count=None):
         """
         Args:
             doc: str
+            sentence_count: int -- number of sentences in doc, if known
+                            already; otherwise doc is segmented
         """
         self.doc = unidecode(doc)
-        self.sentence_count = len(sent_tokenize(doc))
+        self.sentence_count = sentence_count or len(segmenter.spans(doc))
         words = word_tokenize(doc)
         syllables = [self._count_syllables(word) for word in words]
         self.char_count = sum(len(word) for word in words)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Model registry
+
+Keeps loaded pipelines in memory for the lifetime of the process.
+NB: Must not import sklearn, see serapis.scorer
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-10"
+__email__ = "manuel@summer.ai"
+
+import os
+import time
+import logging
+import threading
+from serapis.config import config
+
+log = logging.getLogger('serapis.registry')
+
+local_path = 'temp_models'
+
+
+class PipelineRegistry(object):
+    """
+    Process-wide cache of loaded pipelines.
+
+    >>> registry.get()
+
+    Loads a pipeline the first time it is requested and keeps it in memory for
+    the lifetime of the process (i.e. the worker or Lambda container), instead
+    of unpacking the archive for every message.
+
+    At most every `check_interval` seconds, checks whether a new version is
+    available. The version is the S3 VersionId or ETag of the archive; if S3
+    can't be reached, the version the local archive was downloaded as (or its
+    mtime) is used instead. A new version is downloaded and loaded first and
+    then swapped in at once, so callers always get a complete pipeline.
+
+    Besides the primary pipeline, shadow pipelines (config.shadow_models, or
+    registered with `register`) are scored alongside it for comparison.
+    """
+
+    PRIMARY = 'primary'
+
+    def __init__(self, check_interval=None):
+        """
+        Args:
+            check_interval: int -- seconds between version checks. Defaults to
+                            config.model_check_interval
+        """
+        if check_interval is None:
+            check_interval = config.model_check_interval
+        self.check_interval = check_interval
+        self._sources = {}
+        self._entries = {}  # name -> (version, pipeline, checked_at)
+        self._lock = threading.Lock()
+        self.register(self.PRIMARY)
+        for key in config.shadow_models or []:
+            self.register(key, key=key)
+
+    @property
+    def shadows(self):
+        """Names of all registered pipelines except the primary one."""
+        return sorted(name for name in self._sources if name != self.PRIMARY)
+
+    def register(self, name, pipeline_bucket=None, key=None):
+        """Registers a pipeline archive under a name. Does not load it yet.
+
+        Args:
+            name: str
+            pipeline_bucket: str -- S3 bucket of the archive, defaults to
+                             config.model_s3_bucket
+            key: str -- S3 key of the archive. Defaults to config.model_zip_name,
+                 or config.model_scorer_name if config.use_compiled_scorer is set.
+                 Keys ending in .npz are loaded as LinearScorer.
+        """
+        pipeline_bucket = pipeline_bucket or config.model_s3_bucket
+        key = key or (config.model_scorer_name if config.use_compiled_scorer else config.model_zip_name)
+        with self._lock:
+            self._sources[name] = (pipeline_bucket, key)
+            self._entries.pop(name, None)
+
+    def get(self, name=PRIMARY):
+        """Returns the current PackagedPipeline registered under name.
+
+        Args:
+            name: str
+        Returns:
+            PackagedPipeline or LinearScorer -- both offer metadata, classes_
+                                                and predict_proba(data)
+        """
+        entry = self._entries.get(name)
+        if entry and time.time() - entry[2] < self.check_interval:
+            return entry[1]
+        with self._lock:
+            return self._refresh(name)
+
+    def version(self, name=PRIMARY):
+        """Returns the version of the pipeline currently loaded under name, or None."""
+        entry = self._entries.get(name)
+        return entry[0] if entry else None
+
+    def _refresh(self, name):
+        entry = self._entries.get(name)
+        if entry and time.time() - entry[2] < self.check_interval:
+            return entry[1]  # Another thread refreshed while we were waiting
+
+        pipeline_bucket, key = self._sources[name]
+        filename = os.path.join(local_path, key)
+        version = self._remote_version(pipeline_bucket, key)
+        if version is None:
+            if not os.path.exists(filename):
+                if entry:
+                    self._entries[name] = (entry[0], entry[1], time.time())
+                    return entry[1]
+                message = "No pipeline available for '%s': %s not found" % (name, filename)
+                log.warning(message)
+                raise Exception(message)
+            # The S3 version the archive was downloaded as, so an outage doesn't reload it
+            version = self._local_version(filename) or str(os.path.getmtime(filename))
+        elif version != self._local_version(filename):
+            try:
+                self._download(pipeline_bucket, key, filename, version)
+            except Exception:  # Already logged; keep the pipeline we have until the next check
+                if not entry:
+                    raise
+                self._entries[name] = (entry[0], entry[1], time.time())
+                return entry[1]
+
+        if entry and entry[0] == version:
+            pipeline = entry[1]
+        else:
+            try:
+                pipeline = self._load(filename)
+            except Exception, e:
+                message = "Issue returning from file: %s %s" % (e, type(e))
+                log.warning(message)
+                raise Exception(message)
+            log.info("Loaded pipeline '%s' version %s" % (name, version))
+
+        self._entries[name] = (version, pipeline, time.time())
+        return pipeline
+
+    @staticmethod
+    def _load(filename):
+        """Loads a compiled scorer or a pipeline archive. Imports lazily, so
+        that using the scorer never imports sklearn."""
+        if filename.endswith('.npz'):
+            from serapis.scorer import LinearScorer
+            return LinearScorer.load(filename)
+        from serapis.persist_model import PackagedPipeline
+        return PackagedPipeline.from_file(filename)
+
+    @staticmethod
+    def _remote_version(pipeline_bucket, key):
+        try:
+            head = config.s3_client.head_object(Bucket=pipeline_bucket, Key=key)
+        except Exception, e:
+            log.info("Could not check pipeline version on s3: %s %s" % (e, type(e)))
+            return None
+        return head.get('VersionId') or head['ETag'].strip('"')
+
+    @staticmethod
+    def _local_version(filename):
+        if not os.path.exists(filename) or not os.path.exists(filename + '.version'):
+            return None
+        with open(filename + '.version', 'rt') as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _download(pipeline_bucket, key, filename, version):
+        """Downloads next to the target and renames, so that other processes
+        never see a half-written archive."""
+        if not os.path.exists(local_path):
+            os.makedirs(local_path)
+        partial = "%s.%s.part" % (filename, os.getpid())
+        try:
+            config.s3_client.download_file(pipeline_bucket, key, partial)
+        except Exception, e:
+            message = "Something went wrong pulling from s3: %s %s" % (e, type(e))
+            log.warning(message)
+            raise Exception(message)
+        os.rename(partial, filename)
+        with open(filename + '.version', 'wt') as f:
+            f.write(version)
+
+
+registry = PipelineRegistry()
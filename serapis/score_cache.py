@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Score cache
+
+The same cleaned sentences show up over and over (syndicated articles,
+dictionary mirrors, retries of the same word), so detect remembers the
+predicted probabilities of every sentence it has scored.
+
+NB: Must not import sklearn, see serapis.scorer
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-12"
+__email__ = "manuel@summer.ai"
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+from serapis.config import config
+
+log = logging.getLogger('serapis.score_cache')
+
+
+class ScoreCache(object):
+    """
+    Bounded LRU cache mapping a hash of (s_clean, POS string, model version)
+    to the predicted probabilities of that sentence.
+
+    >>> key = score_cache.key(s_clean, pos, version)
+    >>> score_cache.get(key) or score_cache.put(key, proba_row)
+
+    If a filename is given, the cache is loaded from it on start and written
+    back at most every SAVE_INTERVAL seconds, so that it survives restarts of
+    the worker or Lambda container.
+    """
+
+    SAVE_INTERVAL = 60
+
+    def __init__(self, max_size, filename=None):
+        """
+        Args:
+            max_size: int -- maximum number of entries; the least recently
+                      used ones are evicted first
+            filename: str -- optional file to persist the cache to
+        """
+        self.max_size = max_size
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._saved_at = time.time()
+        self._dirty = False
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(s_clean, pos, version):
+        """
+        Args:
+            s_clean: str -- cleaned sentence
+            pos: str -- POS tags, e.g. 'DT JJ NN'
+            version: str -- identifies the model that scores the sentence
+        Returns:
+            str -- hex digest
+        """
+        return hashlib.md5("\x00".join((s_clean, pos, version)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def model_version(model):
+        """Identifies a model by its metadata (creation date, parameters etc.),
+        so a LinearScorer shares its entries with the pipeline it was compiled
+        from.
+
+        Args:
+            model: PackagedPipeline or LinearScorer
+        Returns:
+            str
+        """
+        return hashlib.md5(json.dumps(model.metadata, sort_keys=True, default=str)).hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple -- cached probabilities, or None
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value  # Re-insert as most recently used
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Args:
+            key: str -- see ScoreCache.key
+            value: tuple -- probabilities of each class
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = tuple(value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def stats(self):
+        """
+        Returns:
+            dict -- hits, misses, hit_rate and size since the process started
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            'size': len(self._entries)
+        }
+
+    def load(self, filename):
+        """Loads entries written by save. A broken cache file is ignored."""
+        try:
+            with open(filename, 'rb') as f:
+                entries = pickle.load(f)
+        except Exception, e:
+            log.warning("Could not load score cache from %s: %s" % (filename, e))
+            return
+        with self._lock:
+            self._entries = OrderedDict(entries[-self.max_size:])
+
+    def save(self, filename=None):
+        """Writes all entries to filename (defaults to the cache's filename),
+        from least to most recently used."""
+        filename = filename or self.filename
+        with self._lock:
+            entries = self._entries.items()
+            self._dirty = False
+            self._saved_at = time.time()
+        # Write to a temporary file first so other processes never read half a cache
+        with open(filename + ".part", 'wb') as f:
+            pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename + ".part", filename)
+
+    def maybe_save(self):
+        """Saves the cache if it is persisted, has changed and hasn't been
+        saved for SAVE_INTERVAL seconds."""
+        if self.filename and self._dirty and time.time() - self._saved_at >= self.SAVE_INTERVAL:
+            try:
+                self.save()
+            except Exception, e:
+                log.warning("Could not save score cache to %s: %s" % (self.filename, e))
+
+
+score_cache = ScoreCache(config.score_cache_size, config.score_cache_file) if config.score_cache_size else None
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Compiled linear scorer
+
+Scores sentences with a fitted feature union of TF-IDF blocks (optionally
+followed by SelectKBest) and a MultinomialNB using nothing but numpy, so that
+the Lambda path doesn't have to import sklearn, scipy or pandas.
+
+    >>> LinearScorer.from_pipeline(packaged_pipeline).save("model.npz")
+    >>> scorer = LinearScorer.load("model.npz")
+    >>> scorer.predict_proba({'s_clean': [...], 'pos': [...]})
+
+NB: This module must not import sklearn.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-10"
+__email__ = "manuel@summer.ai"
+
+import re
+import json
+import numpy as np
+
+
+class CompiledBlock(object):
+    """
+    One ItemSelector -> TF-IDF vectorizer (-> feature selection) block of a
+    FeatureUnion.
+
+    Properties:
+        key: str -- key of the input data this block reads
+        vocabulary: dict -- maps tokens and n-grams to rows of idf and weights
+        idf: np.ndarray -- idf of every token in the vocabulary, including
+             the ones removed by feature selection (they count towards the norm)
+        weights: np.ndarray -- (n_tokens, n_classes) idf times the class log
+                 probability of each token; zero for tokens that were not selected
+        settings: dict -- analyzer and TF-IDF settings
+    """
+
+    def __init__(self, key, vocabulary, idf, weights, settings):
+        self.key = key
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.settings = settings
+        self._token_re = re.compile(settings['token_pattern'])
+        self._stop_words = frozenset(settings['stop_words'] or [])
+
+    def analyze(self, doc):
+        """Same as TfidfVectorizer.build_analyzer() for analyzer='word'"""
+        if self.settings['lowercase']:
+            doc = doc.lower()
+        tokens = self._token_re.findall(doc)
+        if self._stop_words:
+            tokens = [t for t in tokens if t not in self._stop_words]
+        min_n, max_n = self.settings['ngram_range']
+        if max_n == 1:
+            return tokens
+        ngrams = list(tokens) if min_n == 1 else []
+        for n in range(max(min_n, 2), min(max_n, len(tokens)) + 1):
+            ngrams.extend(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return ngrams
+
+    def term_frequencies(self, docs):
+        """
+        Returns:
+            tuple -- row, vocabulary index and (transformed) term frequency of
+                     every known token in docs, as three aligned arrays
+        """
+        rows, cols, tfs = [], [], []
+        vocabulary = self.vocabulary
+        for row, doc in enumerate(docs):
+            counts = {}
+            for token in self.analyze(doc):
+                col = vocabulary.get(token)
+                if col is not None:
+                    counts[col] = counts.get(col, 0) + 1
+            rows.extend([row] * len(counts))
+            cols.extend(counts.keys())
+            tfs.extend(counts.values())
+        tf = np.array(tfs, dtype=np.float64)
+        if self.settings['binary']:
+            tf[:] = 1.0
+        if self.settings['sublinear_tf']:
+            tf = np.log(tf) + 1
+        return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp), tf
+
+    def joint_log_likelihood(self, docs):
+        """
+        Returns:
+            np.ndarray -- (len(docs), n_classes) contribution of this block
+        """
+        rows, cols, tf = self.term_frequencies(docs)
+        values = tf * self.idf[cols]
+        norm = np.zeros(len(docs))
+        if self.settings['norm'] == 'l2':
+            np.add.at(norm, rows, values ** 2)
+            norm = np.sqrt(norm)
+        elif self.settings['norm'] == 'l1':
+            np.add.at(norm, rows, np.abs(values))
+        else:
+            norm[:] = 1.0
+        norm[norm == 0.0] = 1.0
+        result = np.zeros((len(docs), self.weights.shape[1]))
+        np.add.at(result, rows, (tf / norm[rows] * self.settings['weight'])[:, np.newaxis] * self.weights[cols])
+        return result
+
+
+class LinearScorer(object):
+    """
+    Dependency-free replacement for a fitted feature union and MultinomialNB.
+
+    Properties:
+        classes_: np.ndarray -- same as MultinomialNB.classes_
+        metadata: dict -- metadata of the pipeline it was compiled from
+    """
+
+    def __init__(self, blocks, class_log_prior, classes, metadata=None):
+        self.blocks = blocks
+        self.class_log_prior = class_log_prior
+        self.classes_ = classes
+        self.metadata = metadata or {}
+
+    def predict_proba(self, data, cache=None):
+        """Same as pipeline.predict_proba(feature_union.transform(data))
+
+        Args:
+            data: dict -- maps keys to lists of strings, e.g.
+                  {'s_clean': [...], 'pos': [...]}
+            cache: dict -- ignored, for compatibility with PackagedPipeline
+        Returns:
+            np.ndarray -- (n_samples, n_classes)
+        """
+        n_samples = len(data[self.blocks[0].key])
+        jll = np.tile(self.class_log_prior, (n_samples, 1))
+        for block in self.blocks:
+            jll += block.joint_log_likelihood(data[block.key])
+        # log-sum-exp normalisation, as in sklearn's BaseNB
+        top = jll.max(axis=1)[:, np.newaxis]
+        log_prob_x = np.log(np.exp(jll - top).sum(axis=1))[:, np.newaxis] + top
+        return np.exp(jll - log_prob_x)
+
+    @classmethod
+    def from_pipeline(cls, packaged_pipeline):
+        """Compiles a PackagedPipeline. Only supports word analyzers without
+        custom preprocessors or tokenizers.
+
+        Args:
+            packaged_pipeline: PackagedPipeline
+        Returns:
+            LinearScorer
+        """
+        feature_union = packaged_pipeline._feature_union
+        model = packaged_pipeline._pipeline
+        weights = feature_union.transformer_weights or {}
+        feature_log_prob = np.asarray(model.feature_log_prob_)
+
+        blocks, offset = [], 0
+        for name, transformer in feature_union.transformer_list:
+            steps = [step for _, step in getattr(transformer, 'steps', [(name, transformer)])]
+            selector = [s for s in steps if hasattr(s, 'key')]
+            vectorizer = [s for s in steps if hasattr(s, 'vocabulary_')]
+            support = [s for s in steps if hasattr(s, 'get_support')]
+            if len(selector) != 1 or len(vectorizer) != 1 or len(steps) != 2 + len(support):
+                raise ValueError("Can't compile block '{}': expected ItemSelector -> Vectorizer (-> Selection)".format(name))
+            vectorizer = vectorizer[0]
+            if vectorizer.analyzer != 'word' or vectorizer.preprocessor or vectorizer.tokenizer or vectorizer.strip_accents:
+                raise ValueError("Can't compile block '{}': only plain word analyzers are supported".format(name))
+
+            n_tokens = len(vectorizer.vocabulary_)
+            idf = np.asarray(vectorizer.idf_, dtype=np.float64) if getattr(vectorizer, 'use_idf', False) else np.ones(n_tokens)
+            columns = np.arange(n_tokens)
+            if support:
+                mask = support[0].get_support()
+                columns = np.full(n_tokens, -1, dtype=np.intp)
+                columns[mask] = np.arange(mask.sum())
+            n_columns = columns.max() + 1
+            block_weights = np.zeros((n_tokens, feature_log_prob.shape[0]))
+            selected = columns >= 0
+            block_weights[selected] = idf[selected, np.newaxis] * feature_log_prob[:, offset + columns[selected]].T
+            offset += n_columns
+
+            stop_words = vectorizer.get_stop_words()
+            settings = {
+                'token_pattern': vectorizer.token_pattern,
+                'lowercase': vectorizer.lowercase,
+                'stop_words': sorted(stop_words) if stop_words else None,
+                'ngram_range': list(vectorizer.ngram_range),
+                'binary': vectorizer.binary,
+                'sublinear_tf': getattr(vectorizer, 'sublinear_tf', False),
+                'norm': getattr(vectorizer, 'norm', None),
+                'weight': weights.get(name, 1.0)
+            }
+            blocks.append(CompiledBlock(selector[0].key, dict(vectorizer.vocabulary_), idf, block_weights, settings))
+
+        if offset != feature_log_prob.shape[1]:
+            raise ValueError("Feature union produces {} features, but model expects {}".format(offset, feature_log_prob.shape[1]))
+        return cls(blocks, np.asarray(model.class_log_prior_, dtype=np.float64), np.asarray(model.classes_),
+                   getattr(packaged_pipeline, 'metadata', None))
+
+    def save(self, filename):
+        """Writes the scorer to a single .npz file (no pickles)."""
+        arrays = {
+            'class_log_prior': self.class_log_prior,
+            'classes': self.classes_,
+        }
+        header = {'metadata': self.metadata, 'blocks': []}
+        for idx, block in enumerate(self.blocks):
+            # Vocabulary indices are 0..n-1, so the token array is the inverse mapping
+            tokens = sorted(block.vocabulary, key=block.vocabulary.get)
+            arrays['tokens_{}'.format(idx)] = np.array(tokens, dtype=np.unicode_)
+            arrays['idf_{}'.format(idx)] = block.idf
+            arrays['weights_{}'.format(idx)] = block.weights
+            header['blocks'].append({'key': block.key, 'settings': block.settings})
+        arrays['header'] = np.array(json.dumps(header), dtype=np.unicode_)
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a scorer written by save."""
+        with np.load(filename) as npz:
+            header = json.loads(npz['header'].item())
+            blocks = []
+            for idx, block in enumerate(header['blocks']):
+                tokens = npz['tokens_{}'.format(idx)].tolist()
+                vocabulary = dict(zip(tokens, range(len(tokens))))
+                blocks.append(CompiledBlock(block['key'], vocabulary, npz['idf_{}'.format(idx)],
+                                            npz['weights_{}'.format(idx)], block['settings']))
+            return cls(blocks, npz['class_log_prior'], npz['classes'], header['metadata'])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Sentence segmentation
+
+Splits paragraphs into sentences with NLTK's Punkt model, which is loaded
+once per process, and returns character offsets so that later stages can
+slice sentences instead of segmenting the same text again.
+
+    >>> texts_and_spans = segmenter.segment(paragraphs)
+
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-17"
+__email__ = "manuel@summer.ai"
+
+import re
+import nltk.data
+
+# Applied to paragraphs before segmenting them
+REWRITES = (
+    (re.compile(r"([^ ])([\(\[\"])"), r"\1 \2"),  # Give brackets space to breathe
+    (re.compile(r"([\)\]\"\!\?:])([^ ])"), r"\1 \2"),
+    (re.compile(r"([^. ]{3})\.([^. ]{3}|A |An )"), r"\1. \2"),
+    (re.compile(r" e\.?g\.? "), " _eg_ "),  # Punkt improperly splits sentences here
+    (re.compile(r" i\.?e\.? "), " _ie_ "),
+)
+
+
+class SentenceSegmenter(object):
+    """
+    Segments paragraphs the same way as nltk.sent_tokenize, but keeps the
+    Punkt tokenizer around and returns offsets.
+
+    Properties:
+        language: str -- name of the Punkt model
+        tokenizer: PunktSentenceTokenizer -- loaded on first use
+    """
+
+    def __init__(self, language='english'):
+        self.language = language
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = nltk.data.load('tokenizers/punkt/{}.pickle'.format(self.language))
+        return self._tokenizer
+
+    def rewrite(self, paragraph):
+        """Applies REWRITES to a paragraph."""
+        for regex, replacement in REWRITES:
+            paragraph = regex.sub(replacement, paragraph)
+        return paragraph
+
+    def spans(self, text):
+        """
+        Returns:
+            list -- (start, end) of every sentence in text
+        """
+        return list(self.tokenizer.span_tokenize(text))
+
+    def segment(self, paragraphs):
+        """Rewrites and segments paragraphs, one at a time. Segmenting the
+        paragraphs joined together lets sentences run across paragraph breaks
+        and changes where Punkt breaks the last sentence of a paragraph.
+
+        Args:
+            paragraphs: list -- str
+        Returns:
+            list -- (rewritten paragraph, list of (start, end) of every
+                    sentence in it) for each paragraph
+        """
+        return [(text, self.spans(text)) for text in map(self.rewrite, paragraphs)]
+
+    def sentences(self, text):
+        """Same as nltk.sent_tokenize(text)"""
+        return [text[start:end] for start, end in self.spans(text)]
+
+
+segmenter = SentenceSegmenter()
@@ -8,30 +8,279 @@ __copyright__ = "Copyright 2016, summer.ai & Wordnik"
 __date__ = "2016-01-02"
 __email__ = "clare+github@thegeometrist.com"
 
+import time
 import datetime
+import itertools
+import multiprocessing
+from collections import defaultdict
 import numpy as np
 import pandas as pd
+from scipy import sparse
 
 from sklearn.cross_validation import train_test_split
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
 from sklearn.pipeline import Pipeline, FeatureUnion
 from sklearn.feature_selection import SelectKBest
 from serapis.learning_utils import ItemSelector
 from sklearn.naive_bayes import MultinomialNB
-from sklearn.grid_search import GridSearchCV
-from sklearn.metrics import precision_recall_fscore_support, roc_curve, auc
+from sklearn.base import clone
+from sklearn.metrics import precision_recall_fscore_support, roc_curve, auc, roc_auc_score
 from serapis.persist_model import PackagedPipeline
+from serapis.util import get_git_hash
 
 import logging
 log = logging.getLogger('serapis.sklearn_model')
 
+PARAM_GRID = {
+    'union__x__best__k': [1, 100, 1000, 10000],
+    'mnb__alpha': [0.01, 0.1, 1.0]
+}
+
+
 def get_training_data():
     data = pd.DataFrame.from_csv('training_data_here.csv')
     x = data['data']
     y = data['label']
-    return train_test_split(x, y)
+    x_train, x_test, y_train, y_test = train_test_split(x, y)
+    return {'x': list(x_train)}, {'x': list(x_test)}, np.array(y_train), np.array(y_test)
+
+
+def stratified_folds(y, n_folds=3, random_state=42):
+    """Splits sample indices into folds with the same class balance.
+
+    Returns:
+        list -- (train_indices, test_indices) tuples
+    """
+    y = np.asarray(y)
+    rng = np.random.RandomState(random_state)
+    fold = np.empty(len(y), dtype=int)
+    for label in np.unique(y):
+        idx = rng.permutation(np.where(y == label)[0])
+        fold[idx] = np.arange(len(idx)) % n_folds
+    return [(np.where(fold != i)[0], np.where(fold == i)[0]) for i in range(n_folds)]
+
+
+def _candidates(param_grid):
+    """All combinations of the values in param_grid, as dicts."""
+    keys = sorted(param_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[param_grid[key] for key in keys])]
+
+
+def _selection_steps(feature_union):
+    """
+    Returns:
+        list -- (block name, step name) of the SelectKBest step of each block,
+                or (block name, None) for blocks without one
+    """
+    steps = []
+    for name, transformer in feature_union.transformer_list:
+        selection = [step for step, estimator in getattr(transformer, 'steps', []) if isinstance(estimator, SelectKBest)]
+        steps.append((name, selection[0] if selection else None))
+    return steps
+
+
+def _top_k(scores, k):
+    """Same mask as SelectKBest(k=k) with these scores.
+
+    Raises:
+        ValueError -- if k is not 'all' or between 1 and the number of features,
+                      where SelectKBest would raise or behave differently
+                      between scikit-learn versions
+    """
+    if k != 'all' and not 0 < k <= len(scores):
+        raise ValueError("k should be 'all' or between 1 and {}, got {}".format(len(scores), k))
+    scores = np.where(np.isnan(scores), np.finfo(scores.dtype).min, scores)
+    mask = np.zeros(scores.shape, dtype=bool)
+    if k == 'all':
+        mask[:] = True
+    else:
+        mask[np.argsort(scores, kind="mergesort")[-k:]] = True
+    return mask
+
+
+def _clip_k(k, n_features):
+    """A k larger than the vocabulary of a (small) training set selects all
+    features, so one grid fits training sets of any size."""
+    return k if k == 'all' or k < n_features else 'all'
+
+
+def fit_feature_union(feature_union, x, y):
+    """Fits the feature union like search evaluates it, i.e. SelectKBest
+    steps with a k larger than the number of features select all of them.
+
+    Returns:
+        FeatureUnion -- the fitted feature_union
+    """
+    configured_k = {}
+    for block, step in _selection_steps(feature_union):
+        if step:
+            param = '{}__{}__k'.format(block, step)
+            configured_k[param] = (block, step, feature_union.get_params()[param])
+            feature_union.set_params(**{param: 'all'})
+    feature_union.fit(x, y)
+    blocks = dict(feature_union.transformer_list)
+    for param, (block, step, k) in configured_k.items():
+        # SelectKBest only applies k when transforming, so there is no need to refit
+        feature_union.set_params(**{param: _clip_k(k, len(blocks[block].named_steps[step].scores_))})
+    return feature_union
+
+
+def _fold_features(feature_union, group, x, y, train, test):
+    """Fits the feature union of a group of candidates on one fold and
+    transforms the fold.
+
+    All candidates in the group share the parameters of the feature union
+    except for the k of its SelectKBest steps. So the union is only fitted
+    once, with all features, and each candidate just picks its top k columns
+    by the feature scores (see _evaluate).
+
+    Returns:
+        dict -- features and labels of the fold, and the selection step,
+                feature scores and configured k of every block
+    """
+    start = time.time()
+    selection_steps = _selection_steps(feature_union)
+    union = clone(feature_union).set_params(**{key[len('union__'):]: value for key, value in group[0].items()
+                                               if key.startswith('union__')})
+    configured_k = []
+    for block, step in selection_steps:
+        configured_k.append(union.get_params()['{}__{}__k'.format(block, step)] if step else None)
+        if step:
+            union.set_params(**{'{}__{}__k'.format(block, step): 'all'})
+    x_train = {key: [values[i] for i in train] for key, values in x.items()}
+    x_test = {key: [values[i] for i in test] for key, values in x.items()}
+    union.fit(x_train, y[train])
+    blocks = dict(union.transformer_list)
+    return {
+        'selection_steps': selection_steps,
+        'configured_k': configured_k,
+        'scores': [blocks[block].named_steps[step].scores_ if step else None for block, step in selection_steps],
+        'train': [blocks[block].transform(x_train) for block, _ in selection_steps],
+        'test': [blocks[block].transform(x_test) for block, _ in selection_steps],
+        'y_train': y[train],
+        'y_test': y[test],
+        'transform_time': (time.time() - start) / len(group)
+    }
+
+
+_worker_state = {}  # model and fold features, see _init_worker
+
+
+def _init_worker(model, folds):
+    """Hands the model and the features of all folds to a worker process
+    once, so that tasks only need to name a fold and a candidate."""
+    _worker_state.update(model=model, folds=folds)
+
+
+def _evaluate(task):
+    """Evaluates a candidate on one fold. Runs in a worker process.
+
+    Args:
+        task: tuple -- ((group, fold) key of the fold features, candidate params)
+    Returns:
+        dict -- params, fold, score, fit_time, score_time
+    """
+    fold_key, candidate = task
+    features = _worker_state['folds'][fold_key]
+    start = time.time()
+    columns = []
+    for (block, step), scores, k in zip(features['selection_steps'], features['scores'], features['configured_k']):
+        if step:
+            k = _clip_k(candidate.get('union__{}__{}__k'.format(block, step), k), len(scores))
+            columns.append(np.where(_top_k(scores, k))[0])
+        else:
+            columns.append(None)
+    X_train = sparse.hstack([f if c is None else f[:, c] for f, c in zip(features['train'], columns)]).tocsr()
+    X_test = sparse.hstack([f if c is None else f[:, c] for f, c in zip(features['test'], columns)]).tocsr()
+    estimator = clone(_worker_state['model']).set_params(**{key[len('mnb__'):]: value for key, value in candidate.items()
+                                                            if key.startswith('mnb__')})
+    estimator.fit(X_train, features['y_train'])
+    fit_time = time.time() - start + features['transform_time']
+    start = time.time()
+    proba = estimator.predict_proba(X_test)[:, -1]
+    return {
+        'params': candidate,
+        'fold': fold_key[1],
+        'score': float(roc_auc_score(features['y_test'], proba)),
+        'fit_time': fit_time,
+        'score_time': time.time() - start
+    }
 
-def build_pipeline():
+
+def search(feature_union, model, x, y, param_grid=PARAM_GRID, n_folds=3, n_jobs=None):
+    """Grid search over the parameters of the feature union and the model.
+
+    Replaces GridSearchCV, which refits the TF-IDF vectorizers and feature
+    selection for every candidate: candidates that only differ in the k of
+    SelectKBest or in model parameters share one fitted feature union per
+    fold. Each fold is transformed once in this process; a process pool then
+    fits and scores the model for each candidate. Workers receive the fold
+    features once, when they start, so tasks only carry a fold key and the
+    candidate's parameters.
+
+    Args:
+        feature_union: FeatureUnion -- parameters are prefixed with 'union__'
+        model: classifier with predict_proba -- parameters are prefixed with 'mnb__'
+        x: dict -- maps keys to lists of strings
+        y: np.ndarray -- labels; the last class counts as positive
+        param_grid: dict -- maps parameter names to lists of values
+        n_folds: int
+        n_jobs: int -- worker processes, defaults to the number of cores
+    Returns:
+        tuple -- (best params, list of per-candidate results with mean
+                 score and fit/score timings)
+    """
+    candidates = _candidates(param_grid)
+    for candidate in candidates:
+        # Raises ValueError for names that don't match a step
+        Pipeline([('union', clone(feature_union)), ('mnb', clone(model))]).set_params(**candidate)
+
+    k_params = set('union__{}__{}__k'.format(block, step) for block, step in _selection_steps(feature_union) if step)
+    groups = defaultdict(list)
+    for candidate in candidates:
+        groups[repr(sorted((key, value) for key, value in candidate.items()
+                           if key.startswith('union__') and key not in k_params))].append(candidate)
+
+    y = np.asarray(y)
+    groups = list(groups.values())
+    folds = {}
+    for fold, (train, test) in enumerate(stratified_folds(y, n_folds)):
+        for group_idx, group in enumerate(groups):
+            folds[(group_idx, fold)] = _fold_features(feature_union, group, x, y, train, test)
+    tasks = [(fold_key, candidate) for fold_key in sorted(folds) for candidate in groups[fold_key[0]]]
+    if n_jobs == 1:
+        _init_worker(model, folds)
+        try:
+            candidate_results = map(_evaluate, tasks)
+        finally:
+            _worker_state.clear()
+    else:
+        pool = multiprocessing.Pool(n_jobs, _init_worker, (model, folds))
+        try:
+            candidate_results = pool.map(_evaluate, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    by_candidate = defaultdict(list)
+    for result in candidate_results:
+        by_candidate[repr(sorted(result['params'].items()))].append(result)
+    results = []
+    for candidate in candidates:
+        folds = by_candidate[repr(sorted(candidate.items()))]
+        results.append({
+            'params': candidate,
+            'mean_score': float(np.mean([f['score'] for f in folds])),
+            'scores': [f['score'] for f in folds],
+            'fit_time': [f['fit_time'] for f in folds],
+            'score_time': [f['score_time'] for f in folds]
+        })
+    best = max(results, key=lambda result: result['mean_score'])
+    log.info("Best parameters %s, mean AUC %.4f" % (best['params'], best['mean_score']))
+    return best['params'], results
+
+
+def build_pipeline(param_grid=PARAM_GRID, n_folds=3, n_jobs=None):
     x_train, x_test, y_train, y_test = get_training_data()
     tfidf = TfidfVectorizer()
 
@@ -44,32 +293,149 @@ def build_pipeline():
                     ]))
                 ])
 
-    X_features = feature_union.fit(x_train, y_train).transform(x_train)
-    param_grid = dict(univ_select__k=[1,100,1000,10000], mnb__alpha=[0.01, 0.1, 1.0])
-    grid = GridSearchCV(MultinomialNB(), param_grid=param_grid)
-    grid.fit(X_features, y_train)
-    c = grid.best_estimator_
+    start = time.time()
+    best_params, search_results = search(feature_union, MultinomialNB(), x_train, y_train,
+                                         param_grid=param_grid, n_folds=n_folds, n_jobs=n_jobs)
+    search_time = time.time() - start
+    c = MultinomialNB()
+    Pipeline([('union', feature_union), ('mnb', c)]).set_params(**best_params)
+
+    X_features = fit_feature_union(feature_union, x_train, y_train).transform(x_train)
+    c.fit(X_features, y_train)
 
     X_test = feature_union.transform(x_test)
     pred = np.array(c.predict(X_test))
     pred_proba = np.array([a[1] for a in c.predict_proba(X_test)])
-    precision, recall, fscore, support = precision_recall_fscore_support(actual, pred)
-    fpr, tpr, thresholds = roc_curve(actual, pred)
+    precision, recall, fscore, support = precision_recall_fscore_support(y_test, pred)
+    fpr, tpr, thresholds = roc_curve(y_test, pred_proba)
     auc_score = auc(fpr, tpr)
 
     now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
 
     metadata = {
-        'pipeline':      str(grid.best_estimator_),
+        'pipeline':      str(c),
+        'feature_union': str(feature_union),
         'created_at':    now,
-        'git_hash':      0,
+        'git_hash':      get_git_hash(),
         'precision':     [float(p) for p in precision],
         'recall':        [float(r) for r in recall],
         'fscore':        [float(f) for f in fscore],
         'support':       [int(s) for s in support],
-        'auc': auc_score
+        'auc':           auc_score,
+        'search': {
+            'best_params':   best_params,
+            'n_folds':       n_folds,
+            'search_time':   search_time,
+            'candidates':    search_results
+        }
     }
 
-    p = PackagedPipeline(pipeline=grid.best_estimator_, feature_union=feature_union, metadata=metadata,
+    p = PackagedPipeline(pipeline=c, feature_union=feature_union, metadata=metadata,
         x_train=x_train, y_train=y_train, x_test=x_test, y_test=y_test)
     p.save()
+
+
+def iter_training_chunks(filename, keys=('s_clean', 'pos'), label='label', chunksize=100000):
+    """Reads a labeled CSV in chunks, so it never has to fit into memory.
+
+    Args:
+        filename: str -- CSV with a column for each key and a label column
+        keys: tuple -- text columns to read
+        label: str -- label column
+        chunksize: int -- rows per chunk
+    Yields:
+        tuple -- (x, y) where x maps each key to a list of strings and y is
+                 an np.ndarray of labels
+    """
+    for chunk in pd.read_csv(filename, chunksize=chunksize, encoding='utf-8'):
+        x = {key: chunk[key].fillna('').tolist() for key in keys}
+        yield x, chunk[label].values
+
+
+def build_streaming_pipeline(filename, keys=('s_clean', 'pos'), label='label', classes=(0, 1),
+                             chunksize=100000, n_features=2 ** 20, test_fraction=0.1, max_test_size=100000,
+                             estimator=None, random_state=42, save=True):
+    """Out-of-core alternative to build_pipeline for training sets that don't
+    fit into memory.
+
+    Reads the training CSV in chunks, vectorizes each key with a stateless
+    HashingVectorizer (so there is no vocabulary to fit) and trains the
+    estimator incrementally with partial_fit. A random sample of rows, at most
+    max_test_size, is held out for evaluation.
+
+    NB: Hashed features can't be compiled into a LinearScorer, so only the
+        pipeline archive is saved.
+
+    Args:
+        filename: str -- see iter_training_chunks
+        keys: tuple -- text columns, each gets its own block in the feature union
+        label: str -- label column
+        classes: tuple -- all labels that can occur, required by partial_fit
+        chunksize: int -- rows per chunk
+        n_features: int -- features per block
+        test_fraction: float -- share of rows held out for evaluation
+        max_test_size: int -- stop holding out rows once this many are held out
+        estimator: any classifier with partial_fit and predict_proba, e.g.
+                   SGDClassifier(loss='log'). Defaults to MultinomialNB()
+        random_state: int -- seed for picking the held out rows
+        save: bool -- save the pipeline locally and to S3
+    Returns:
+        PackagedPipeline
+    """
+    feature_union = FeatureUnion(transformer_list=[
+        (key, Pipeline([
+            ('selector', ItemSelector(key=key)),
+            ('hashing', HashingVectorizer(n_features=n_features, non_negative=True))  # MultinomialNB needs counts >= 0
+        ]))
+        for key in keys
+    ])
+    estimator = estimator or MultinomialNB()
+    rng = np.random.RandomState(random_state)
+
+    x_test, y_test = {key: [] for key in keys}, []
+    n_train = 0
+    fitted = False
+    for x, y in iter_training_chunks(filename, keys, label, chunksize):
+        if not fitted:
+            feature_union.fit(x, y)  # Stateless, but marks the transformers as fitted
+            fitted = True
+        held_out = np.where(rng.rand(len(y)) < test_fraction)[0][:max_test_size - len(y_test)]
+        train = np.setdiff1d(np.arange(len(y)), held_out)
+        for key in keys:
+            x_test[key].extend(x[key][i] for i in held_out)
+        y_test.extend(y[held_out].tolist())
+        if not len(train):
+            continue
+        x_train = {key: [x[key][i] for i in train] for key in keys}
+        estimator.partial_fit(feature_union.transform(x_train), y[train], classes=list(classes))
+        n_train += len(train)
+        log.info("Trained on %d sentences" % n_train)
+
+    X_test = feature_union.transform(x_test)
+    pred = np.array(estimator.predict(X_test))
+    pred_proba = estimator.predict_proba(X_test)[:, list(estimator.classes_).index(classes[-1])]
+    precision, recall, fscore, support = precision_recall_fscore_support(y_test, pred)
+    fpr, tpr, thresholds = roc_curve(y_test, pred_proba, pos_label=classes[-1])
+    auc_score = auc(fpr, tpr)
+
+    metadata = {
+        'pipeline':      str(estimator),
+        'feature_union': str(feature_union),
+        'created_at':    datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+        'git_hash':      get_git_hash(),
+        'streaming':     True,
+        'n_train':       n_train,
+        'n_test':        len(y_test),
+        'precision':     [float(p) for p in precision],
+        'recall':        [float(r) for r in recall],
+        'fscore':        [float(f) for f in fscore],
+        'support':       [int(s) for s in support],
+        'auc':           auc_score
+    }
+
+    # Training data is not kept around, only the held out test set
+    p = PackagedPipeline(pipeline=estimator, feature_union=feature_union, metadata=metadata,
+        x_train=None, y_train=None, x_test=x_test, y_test=y_test)
+    if save:
+        p.save()
+    return p
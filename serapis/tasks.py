@@ -13,16 +13,20 @@ __email__ = "manuel@summer.ai"
 
 import os
 import json
+import logging
 from serapis.config import config
 from serapis.search import search_all
 from serapis.save import save_all
-from serapis.features import match_wordnik_rules
+from serapis.features import match_wordnik_rules_batch
 from serapis.annotate import batch_tag_sentences, readability_score
-from serapis.persist_model import PackagedPipeline
+from serapis.registry import registry
+from serapis.score_cache import score_cache
 from serapis.util import now
 import numpy as np
 import codecs
 
+log = logging.getLogger('serapis.tasks')
+
 
 def write_message(task, message):
     """Writes a task with a message to the S3 bucket.
@@ -62,6 +66,102 @@ def search(message):
     return write_message('detect', message)
 
 
+def _pos_only(pos_tags):
+    """Turns 'A/DT _TERM_/JJ culture/NN' into 'DT JJ NN'"""
+    return ' '.join([i[i.find('/') + 1:] for i in pos_tags.split()])
+
+
+def _predict(models, data, score_cache=None):
+    """Runs predict_proba of every model, skipping sentences whose
+    probabilities are already in the score cache.
+
+    Args:
+        models: list -- (name, PackagedPipeline or LinearScorer) tuples
+        data: dict -- {'s_clean': [...], 'pos': [...]}
+        score_cache: ScoreCache
+    Returns:
+        list -- (n_sentences, n_classes) probabilities of each model
+    """
+    n_sentences = len(data['s_clean'])
+    cached = []
+    if score_cache is not None:
+        for _, model_pipeline in models:
+            version = score_cache.model_version(model_pipeline)
+            keys = [score_cache.key(s_clean, pos, version) for s_clean, pos in zip(data['s_clean'], data['pos'])]
+            cached.append([(key, score_cache.get(key)) for key in keys])
+        # Models share feature blocks, so all of them score the same rows
+        rows = [row for row in range(n_sentences) if any(c[row][1] is None for c in cached)]
+        data = {key: [values[row] for row in rows] for key, values in data.items()}
+    else:
+        rows = range(n_sentences)
+    cache = {} if len(models) > 1 else None  # block fingerprint -> features, shared between models
+
+    probas = []
+    for model_idx, (_, model_pipeline) in enumerate(models):
+        if score_cache is None:
+            probas.append(model_pipeline.predict_proba(data, cache=cache))
+            continue
+        proba = np.empty((n_sentences, len(model_pipeline.classes_)))
+        if rows:
+            proba[rows] = model_pipeline.predict_proba(data, cache=cache)
+        for row, (key, value) in enumerate(cached[model_idx]):
+            if value is None:
+                score_cache.put(key, proba[row].tolist())
+            else:
+                proba[row] = value
+        probas.append(proba)
+    return probas
+
+
+def score_sentences(models, sentences, score_cache=None):
+    """Scores all sentences with a single transform and a single predict_proba
+    call per model instead of one round-trip per sentence.
+
+    The first model is the primary one and sets 'frd' and 'frd_likelihood' on
+    each sentence dict. If there are shadow models, every model's likelihood
+    is also stored in 'model_likelihoods' under the model's name. Blocks of
+    the feature union that are identical between models are only computed once,
+    and sentences found in score_cache are not transformed at all.
+
+    Args:
+        models: list -- (name, PackagedPipeline or LinearScorer) tuples
+        sentences: list -- sentence dicts with 's_clean' and 'pos_tags'
+        score_cache: ScoreCache -- optional
+    """
+    if not sentences:
+        return
+    data = {
+        's_clean': [sentence['s_clean'] for sentence in sentences],
+        'pos': [_pos_only(sentence['pos_tags']) for sentence in sentences]
+    }
+    probas = _predict(models, data, score_cache)
+
+    for model_idx, ((name, model_pipeline), proba) in enumerate(zip(models, probas)):
+        classes = model_pipeline.classes_
+        class_idx = np.where(classes == 1)[0][0]  # index of '1' pred in .predict_proba
+        likelihoods = [round(float(p), 4) for p in proba[:, class_idx]]  # P(Classification as FRD)
+
+        if model_idx == 0:
+            frds = classes[proba.argmax(axis=1)].tolist()  # same as model.predict
+            for sentence, frd, likelihood in zip(sentences, frds, likelihoods):
+                sentence['frd'] = frd
+                sentence['frd_likelihood'] = likelihood
+        if len(models) > 1:
+            for sentence, likelihood in zip(sentences, likelihoods):
+                sentence.setdefault('model_likelihoods', {})[name] = likelihood
+
+
+def _shadow_models():
+    """Loads all shadow models. A broken shadow model must never break detect."""
+    models = []
+    for name in registry.shadows:
+        try:
+            models.append((name, registry.get(name)))
+        except Exception, e:
+            log.warning("Could not load shadow model '%s': %s" % (name, e))
+    return models
+
+
 def detect(message):
     """Takes a message that must contain a list of URL objects, each having
     at least a doc property. This will split the doc of each URL into
@@ -70,31 +170,25 @@ def detect(message):
     batch_tag_sentences(message)
 
     # Load Models
-    model_pipeline = PackagedPipeline().get()
+    model_pipeline = registry.get()
     created_at = model_pipeline.metadata['created_at']
 
-    feature_union = model_pipeline._feature_union
-    model = model_pipeline._pipeline
-    class_idx = np.where(model.classes_ == 1)[0][0]  # index of '1' pred in .predict_proba
-
+    sentences = []
     for url_object in message['urls']:
         readability_score(url_object)
         for sentence in url_object['sentences']:
-            sentence_clean = sentence['s_clean']
-            pos = ' '.join([i[i.find('/') + 1:] for i in sentence['pos_tags'].split()])  # just pos tags
-            
-            sentence_feature_union = feature_union.transform({
-                's_clean': [sentence['s_clean']],
-                'pos': [pos]
-            })
-
             # metadata
             sentence['model_creation_date'] = created_at
-            
-            # predictions from model
-            sentence['patterns'] = match_wordnik_rules(sentence_clean)
-            sentence['frd'] = model.predict(sentence_feature_union)[0]
-            sentence['frd_likelihood'] = round(model.predict_proba(sentence_feature_union)[0][class_idx], 4)  # P(Classification as FRD)
+            sentences.append(sentence)
+    patterns = match_wordnik_rules_batch([sentence['s_clean'] for sentence in sentences], as_matrix=False)
+    for sentence, sentence_patterns in zip(sentences, patterns):
+        sentence['patterns'] = sentence_patterns
+
+    # predictions from model
+    score_sentences([(registry.PRIMARY, model_pipeline)] + _shadow_models(), sentences, score_cache)
+    if score_cache is not None:
+        log.info("Score cache: %(hits)d hits, %(misses)d misses, %(size)d entries" % score_cache.stats())
+        score_cache.maybe_save()
 
     return write_message('save', message)
 
@@ -14,7 +14,7 @@ __copyright__ = "Copyright 2015, summer.ai"
 __date__ = "2015-12-17"
 __email__ = "manuel@summer.ai"
 
-from serapis.preprocess import clean_and_qualify_term
+from serapis.preprocess import clean_and_qualify_term, clean_and_qualify_wordlist, qualify_term
 import codecs
 
 
@@ -22,3 +22,17 @@ def test_disqualify():
     with codecs.open("serapis/tests/data/words_disqualified.txt", 'r', 'utf-8') as wordlist:
         for word in wordlist.readlines():
             assert not clean_and_qualify_term(word), "Word '{}' falsely marked as valid".format(word.strip())
+
+
+def test_qualify_term():
+    qualified = ["déjà vu", "Straße", "a dog", "Ωmega", "naïve résumé", "hipster"]
+    disqualified = ["ßßß abc", "日本語 text", "abc\u3000abc\u3000abc\u3000abc", "a b c", "ab cd ef", "x" * 16, "a1bc", "what?"]
+    assert all(qualify_term(term) for term in qualified)
+    assert not any(qualify_term(term) for term in disqualified)
+
+
+def test_clean_wordlist():
+    wordlist = ["Déjà vu", "deja-vu", "a dog", "dog!", "Deja Vu", "(hipster)", "hipster", "x"] * 500
+    expected = ["Déjà vu", "dog", "hipster"]  # The first of all words that squash to the same string
+    assert list(clean_and_qualify_wordlist(wordlist)) == expected
+    assert list(clean_and_qualify_wordlist((word for word in wordlist), processes=2, chunksize=7)) == expected
@@ -29,3 +29,21 @@ def test_page_structure():
 
     for key in test_output.keys():
         assert output[key] == test_output[key]
+
+
+def test_readability_score_sentence_count():
+    from nltk import sent_tokenize
+    from serapis import benchmark
+    from serapis.annotate import readability_score
+    from serapis.extract import PageRequest
+    from serapis.readability import Readability
+
+    for term, page_text in benchmark.synthetic_pages(benchmark.load_term_sentences(), 5, 30):
+        page = PageRequest(None, term, run=False)
+        url_object = {'doc': page.extract_sentences(page_text), 'doc_sentences': page.doc_sentences}
+        readability_score(url_object)
+        # Counting the extracted sentences instead of segmenting the whole doc again hardly changes the score
+        sentence_count = len(sent_tokenize(url_object['doc']))
+        assert abs(page.doc_sentences - sentence_count) <= 0.03 * sentence_count
+        expected = Readability(url_object['doc'], sentence_count).fleisch_reading_ease()
+        assert abs(url_object['readability_score'] - expected) < 0.5
@@ -45,3 +45,74 @@ def test_extract_html_features():
     test_html = "<div><p><em><strong>de-fen-es-tra-tion</strong></em> (dee-fen-uh-STRAY-shun) |&nbsp;n. the act of throwing someone or something out of a window</p></div><div>"
     test_request.get_html_features(test_html)
     assert test_request.features['highlighted']
+
+
+def test_extract_sentences():
+    from serapis.extract import PageRequest
+
+    paragraph = ("We all know the feeling of a déjà vu when you walk into a room. "
+                 "Some people say that a Deja-vu is a glitch in the brain. "
+                 "The weather was nice and warm this afternoon in the park.")
+    page_text = "\n\n".join([paragraph] * 3)
+    test_request = PageRequest("http://example.com", "deja vu", run=False)
+    doc = test_request.extract_sentences(page_text)
+    assert [s['s_clean'] for s in test_request.sentences] == [
+        "We all know the feeling of a _TERM_ when you walk into a room.",
+        "Some people say that a _TERM_ is a glitch in the brain."]  # Repeated sentences only once
+    assert test_request.variants == {"déjà vu", "Deja-vu"}
+    assert doc.count("glitch") == 3
+
+    test_request = PageRequest("http://example.com", "deja vu", run=False)
+    doc = test_request.extract_sentences(page_text, max_sentences=1)
+    assert len(test_request.sentences) == 1
+    assert doc.count("glitch") == 3  # The page text is still complete
+    assert test_request.doc_sentences == 9
+
+    test_request = PageRequest("http://example.com", "deja vu", run=False)
+    doc = test_request.extract_sentences(page_text, max_sentences=1, narrow=True)
+    assert len(test_request.sentences) == 1
+    assert "glitch" not in doc
+
+
+def test_narrow_page_text():
+    from serapis.extract import PageRequest
+
+    paragraphs = ["The weather was nice and warm this afternoon in the park.",
+                  "We walked along the river for quite a long time.",
+                  "Some people say that a deja vu is a glitch in the brain."]
+    page_text = "\n\n".join(paragraphs)
+    docs = {}
+    for narrow in (False, True):
+        test_request = PageRequest("http://example.com", "deja vu", run=False)
+        docs[narrow] = test_request.extract_sentences(page_text, narrow=narrow)
+        assert [s['s'] for s in test_request.sentences] == paragraphs[-1:]
+    assert docs[False] == " ".join(paragraphs)
+    assert docs[True] == " ".join(paragraphs[1:])  # paragraph_context is 1
+
+
+def test_term_paragraphs():
+    from serapis.extract import term_paragraphs
+    from serapis.preprocess import TermContext
+
+    paragraphs = ["One.", "Two.", "Three is a deja vu.", "Four.", "Five.", "Six.", "Seven, a Déjà-Vu."]
+    context = TermContext("deja vu")
+    assert list(term_paragraphs(paragraphs, context)) == ["Three is a deja vu.", "Seven, a Déjà-Vu."]
+    assert list(term_paragraphs(paragraphs, context, 1)) == ["Two.", "Three is a deja vu.", "Four.", "Six.", "Seven, a Déjà-Vu."]
+
+
+def test_term_sentences():
+    from serapis.extract import term_sentences
+    from serapis.preprocess import TermContext, clean_sentence, paragraph_to_sentences
+
+    paragraphs = ["We all know the feeling of a deja vu. The weather was nice and warm this afternoon.",
+                  "Two.",
+                  "Some people say that a déjà vu is a glitch in the brain. Four.",
+                  "Five people had a Deja-Vu while walking into the room."]
+    context = TermContext("deja vu")
+    expected = [(sentence,) + clean_sentence(sentence, context)
+                for paragraph in paragraphs for sentence in paragraph_to_sentences(paragraph, context)]
+    for batch_size in (1, 2, 10):
+        assert list(term_sentences(paragraphs, context, batch_size)) == expected
+    assert len(expected) == 4
+    assert expected[2] == ("Some people say that a déjà vu is a glitch in the brain.",
+                           "Some people say that a _TERM_ is a glitch in the brain.", {"déjà vu"})
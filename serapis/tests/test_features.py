@@ -21,8 +21,8 @@ import unicodecsv as csv
 
 
 def test_wordnik_patterns_compile():
-    from serapis.features import patterns
-    for rule, pattern in patterns.items():
+    from serapis.features import get_rules
+    for rule, pattern in get_rules().patterns.items():
         assert re.compile(pattern), "Rule {} is not a valid regular expression".format(rule)
 
 
@@ -45,3 +45,96 @@ def test_wordnik_patterns_perc():
         s_clean, _ = clean_sentence(sentence, term)
         matches += 1 if match_wordnik_rules(s_clean) else 0
     assert matches / len(test_cases) > min_coverage, "Only matched {:.2f}% of data set".format(100 * matches / len(test_cases))
+
+
+def test_wordnik_rules_prefilter():
+    from serapis.features import get_rules, match_wordnik_rules
+    from serapis.preprocess import clean_sentence
+    patterns = get_rules().patterns
+    with open("serapis/tests/data/frds_wordnik.csv") as f:
+        test_cases = list(csv.reader(f))
+    s_cleans = [clean_sentence(sentence, term)[0] for term, sentence in test_cases]
+    # Pairs of sentences have several _TERM_s, which makes for overlapping term windows
+    for s_clean in s_cleans + [" ".join(pair) for pair in zip(s_cleans, s_cleans[1:])]:
+        s_lower = s_clean.replace("'_TERM_'", "_TERM_").replace(",", "").lower()
+        expected = [rule for rule, pattern in patterns.items() if pattern.search(s_lower)]
+        assert match_wordnik_rules(s_clean) == expected, "Prefilter changed the rules matching '{}'".format(s_clean)
+
+
+def test_pattern_bundle():
+    import os
+    import shutil
+    import tempfile
+    import serapis.patterns
+    from serapis.features import RuleSet
+    rules = RuleSet.from_patterns(serapis.patterns.compile())
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = rules.save(os.path.join(tmp_dir, "patterns.bundle"), "checksum")
+        loaded = RuleSet.load(filename, "checksum")
+        assert list(loaded.patterns) == list(rules.patterns)
+        sentence = "a tattoo of donald trump or in other words a _term_."
+        assert loaded.match(sentence) == rules.match(sentence)
+        try:
+            RuleSet.load(filename, "other checksum")
+            assert False, "Loaded an out-of-date bundle"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_rule_profiler():
+    import serapis.patterns
+    from serapis.features import RuleSet, RuleProfiler
+    rules = RuleSet.from_patterns(serapis.patterns.compile())
+    sentence = "a tattoo of donald trump or in other words a _term_."
+    expected = rules.match(sentence)
+    shorter = "in other words a _term_."
+    shorter_expected = rules.match(shorter)
+    rules.profiler = RuleProfiler()
+    assert rules.match(sentence) == expected
+    assert all(rules.profiler.stats[rule]['hits'] == 1 for rule in expected)
+    assert rules.profiler.stats['KO16']['worst_sentence'] == sentence
+    assert "KO16" in rules.profiler.report()
+
+    # Every rule exceeds this budget, so after two overruns all are skipped
+    rules.profiler = RuleProfiler(budget=1e-9, skip=True, overruns=2)
+    assert rules.match(sentence) == expected
+    assert rules.match(sentence) == expected  # A single overrun doesn't skip a rule
+    assert rules.match(sentence) == []
+    assert all(stats['over_budget'] == 2 and stats['skipped'] == 1 for stats in rules.profiler.stats.values())
+    # Shorter sentences still run; the rule only needs to be fast enough on them once
+    rules.profiler.budget = None
+    assert shorter_expected and rules.match(shorter) == shorter_expected
+    assert rules.match(sentence + " ") == []
+
+
+def test_trie_alternation():
+    from serapis.patterns import trie_alternation, read_var_files
+    assert trie_alternation(["the", "their", "these"]) == "the(?:ir|se)?"
+    assert trie_alternation(["a", "an", "another"]) == "a(?:n(?:other)?)?"
+    for var, tokens in read_var_files().items():
+        flat = re.compile(r"(?:{})\Z".format("|".join(tokens)), re.IGNORECASE)
+        trie = re.compile(r"(?:{})\Z".format(trie_alternation(tokens)), re.IGNORECASE)
+        for token in tokens:
+            for s in (token, token + "s", token[:-1], token[1:], token.upper()):
+                assert bool(flat.match(s)) == bool(trie.match(s)), "{} differs on '{}'".format(var, s)
+
+
+def test_wordnik_rules_batch():
+    from serapis.features import get_rules, match_wordnik_rules, match_wordnik_rules_batch
+    sentences = ["A tattoo of Donald Trump, or, in other words, a _TERM_.",
+                 "Nothing to see here.",
+                 "A tattoo of Donald Trump, or, in other words, a _TERM_."]
+    expected = [match_wordnik_rules(sentence) for sentence in sentences]
+    assert match_wordnik_rules_batch(sentences, as_matrix=False) == expected
+
+    matrix = match_wordnik_rules_batch(sentences)
+    names = get_rules().names
+    assert matrix.shape == (len(sentences), len(names))
+    assert [[names[col] for col in row.indices] for row in matrix] == expected
+
+    # Columns follow the given rules, other rules are left out
+    matrix = match_wordnik_rules_batch(sentences, rules=["KO3", "KO1000", "KO16"])
+    assert matrix.toarray().tolist() == [[1, 0, 1], [0, 0, 0], [1, 0, 1]]
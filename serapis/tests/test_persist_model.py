@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-09"
+__email__ = "manuel@summer.ai"
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from serapis.benchmark import labeled_data, standin_pipeline
+
+
+def test_pack_mmap():
+    from serapis.persist_model import PackagedPipeline
+    pipeline, (data, _) = standin_pipeline(n=400, k=200, created_at='test'), labeled_data(n=400)
+    directory = tempfile.mkdtemp()
+    try:
+        for mmap in (False, True):
+            filename = pipeline.pack(os.path.join(directory, "pipeline_%s.zip" % mmap), mmap=mmap)
+            loaded = PackagedPipeline.from_file(filename)
+            assert loaded.metadata['created_at'] == 'test'
+            assert np.allclose(loaded.predict_proba(data), pipeline.predict_proba(data))
+
+        # A new version of the archive replaces the directory unpacked from the old one
+        unpacked = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
+        assert len(unpacked) == 1
+        mtime = os.path.getmtime(filename) + 10
+        os.utime(filename, (mtime, mtime))
+        PackagedPipeline.from_file(filename)
+        assert [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))] == \
+            ["pipeline_True.%d" % (mtime * 1000)]
+    finally:
+        shutil.rmtree(directory)
+
+
+class LocalS3(object):
+    """Stands in for config.s3_client, serving files from a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def download_file(self, bucket, key, filename):
+        shutil.copy(os.path.join(self.directory, key), filename)
+
+    def head_object(self, Bucket, Key):
+        filename = os.path.join(self.directory, Key)
+        if not os.path.exists(filename):
+            raise IOError("No such key: %s" % Key)
+        return {'ETag': '"%s"' % os.path.getmtime(filename)}
+
+
+def test_serving_and_evaluation_bundles():
+    import zipfile
+    from contextlib import closing
+    from serapis.config import config
+    from serapis.persist_model import PackagedPipeline, extract_bundle, write_bundle, get_evaluation_data
+    pipeline, (data, _) = standin_pipeline(n=400, k=200, created_at='test'), labeled_data(n=400)
+    directory = tempfile.mkdtemp()
+    s3_client = config.s3_client
+    try:
+        # Training data is only in the evaluation bundle
+        pipeline.pack_evaluation(os.path.join(directory, "test_evaluation.zip"))
+        config._AttrDict__data['s3_client'] = LocalS3(directory)
+        evaluation = get_evaluation_data(key="test_evaluation.zip")
+        assert evaluation['x_train'] == data
+        assert evaluation['metadata']['created_at'] == 'test'
+
+        # Archives made before the split still load, without their training data
+        old_archive = write_bundle(os.path.join(directory, "old.zip"), {
+            'pipeline': pipeline._pipeline, 'feature_union': pipeline._feature_union, 'x_train': data
+        }, pipeline.metadata)
+        loaded = PackagedPipeline.from_file(old_archive)
+        assert loaded._data['x_train'] is None
+        assert np.allclose(loaded.predict_proba(data), pipeline.predict_proba(data))
+
+        # .npy files written by joblib are extracted with their bundle
+        with closing(zipfile.ZipFile(os.path.join(directory, "sidecars.zip"), 'w')) as zfile:
+            for member in ('metadata.json', 'pipeline.bin', 'pipeline.bin_01.npy', 'x_train.bin', 'x_train.bin_01.npy', 'pipeline.binx'):
+                zfile.writestr(member, "")
+        with closing(zipfile.ZipFile(os.path.join(directory, "sidecars.zip"))) as zfile:
+            extract_bundle(zfile, os.path.join(directory, "sidecars"), PackagedPipeline.SERVING)
+        assert sorted(os.listdir(os.path.join(directory, "sidecars"))) == ['metadata.json', 'pipeline.bin', 'pipeline.bin_01.npy']
+    finally:
+        config._AttrDict__data['s3_client'] = s3_client
+        shutil.rmtree(directory)
+        if os.path.exists(os.path.join("temp_models", "test_evaluation.zip")):
+            os.remove(os.path.join("temp_models", "test_evaluation.zip"))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-15"
+__email__ = "manuel@summer.ai"
+
+from serapis.preprocess import TermContext, VariantScan, clean_sentence, collect_variants, normalize, paragraph_to_sentences, preprocess_sentence
+
+
+def test_term_context():
+    context = TermContext("Déjà Vu")
+    assert context.squashed == "dejavu"
+    sentence = "I had a Deja-vu yesterday, or, as the French say, a déjà vu."
+    assert collect_variants(sentence, context) == collect_variants(sentence, "Déjà Vu") == {"Deja-vu", "déjà vu"}
+    assert clean_sentence(sentence, context) == clean_sentence(sentence, "Déjà Vu")
+    assert clean_sentence(sentence, context)[0] == "I had a _TERM_ yesterday, or, as the French say, a _TERM_."
+
+    paragraph = "Rate this definition: Déjà Vu (noun) the feeling of having been somewhere before. It is very common."
+    assert paragraph_to_sentences(paragraph, context) == paragraph_to_sentences(paragraph, "Déjà Vu")
+    assert paragraph_to_sentences(paragraph, context)[0].startswith("Déjà Vu: the feeling")
+
+    assert context.may_contain(paragraph)
+    assert context.may_contain("I had a <b>deja</b>-vu&nbsp;yesterday.")
+    assert not context.may_contain("Nothing to see here, just deja <i>and</i> vu.")
+    # Markup can't hide the term in another sentence
+    paragraph = "5 < 6. Deja vu is > 7 times odd."
+    assert paragraph_to_sentences(paragraph, context) == ["Deja vu is > 7 times odd."]
+    assert context.may_contain(paragraph)
+
+
+def test_term_context_without_letters():
+    sentence = "Dashes -- and spaces are everywhere -- in this sentence."
+    for term in ("--", " ", ""):
+        context = TermContext(term)
+        assert context.squashed == ""
+        assert not context.may_contain(sentence)
+        assert collect_variants(sentence, context) == set()
+        assert VariantScan(sentence, context).spans == []
+
+
+def test_variant_scan():
+    text = "Die Straße… ist eine strasse."
+    normalized, origins = normalize(text)
+    assert normalized == "die strasse... ist eine strasse."
+    assert [text[origins[idx]] for idx in range(4, 11)] == list("Straßes")[:5] + ["ß", "e"]
+    assert normalize("ascii only") == ("ascii only", None)
+
+    # Offsets are mapped back to the original text
+    assert collect_variants(text, "Strasse") == {"Straße", "strasse"}
+    sentences = ["A crap attack… is a “crap-attack”.", "Nothing here.", "Crap attacks happen, Crap attackers too."]
+    scan = VariantScan(" ".join(sentences), "crap attack")
+    start = 0
+    for sentence in sentences:
+        assert scan.clean(start, start + len(sentence)) == clean_sentence(sentence, "crap attack")
+        start += len(sentence) + 1
+    assert scan.clean(0, len(sentences[0]))[0] == "A _TERM_… is a “_TERM_”."
+    # Plurals and longer words keep their ending
+    assert clean_sentence(sentences[2], "crap attack") == ("_TERM_s happen, _TERM_ers too.", {"Crap attack"})
+
+
+def test_segmenter():
+    from nltk import sent_tokenize
+    from serapis.segment import segmenter
+    from serapis.preprocess import paragraphs_to_sentences
+    paragraphs = ["A deja vu, e.g. the one I had, is odd. Mr. Smith had one too! Didn't he?",
+                  "Another paragraph(with brackets) here.Then a second sentence."]
+    for text, spans in segmenter.segment(paragraphs):
+        assert [text[start:end] for start, end in spans] == sent_tokenize(text)
+    assert segmenter.segment(paragraphs)[1][0] == "Another paragraph (with brackets) here. Then a second sentence."
+    assert segmenter.sentences("One. Two.") == ["One.", "Two."]
+    assert paragraphs_to_sentences(paragraphs, "deja vu") == [paragraph_to_sentences(p, "deja vu") for p in paragraphs]
+    assert paragraphs_to_sentences(paragraphs, "deja vu")[0][0] == "A deja vu, e.g. the one I had, is odd."
+
+
+def test_preprocess_sentence():
+    assert preprocess_sentence("Jan 12, 2015 10:00 PM) A <b>deja vu</b> is “odd”!Really.", "deja vu") == \
+        'A deja vu is "odd"! Really.'
+    # Only text right of the last date is kept
+    assert preprocess_sentence("3/4/2015 first, then 5/6/2016 a deja_vu(again).", "deja vu") == "a deja vu (again) ."
+    assert preprocess_sentence("No dates in 2015 &quot;here&rdquo;.", "deja vu") == 'No dates in 2015 "here".'
+    assert preprocess_sentence("Deja vu (noun) (psychology) An odd feeling.", "deja vu") == "deja vu: An odd feeling."
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-10"
+__email__ = "manuel@summer.ai"
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pytest
+from serapis.benchmark import labeled_data, standin_pipeline
+from serapis.tests.test_persist_model import LocalS3
+
+
+class UnavailableS3(object):
+    """Stands in for config.s3_client when S3 can't be reached."""
+
+    def head_object(self, Bucket, Key):
+        raise IOError("S3 is unavailable")
+
+    def download_file(self, bucket, key, filename):
+        raise IOError("S3 is unavailable")
+
+
+class FailingDownloadS3(LocalS3):
+    """Stands in for config.s3_client when versions can be checked but not downloaded."""
+
+    def download_file(self, bucket, key, filename):
+        raise IOError("Download failed")
+
+
+def test_registry_reload():
+    import serapis.registry
+    from serapis.config import config
+    from serapis.registry import PipelineRegistry
+
+    first, second = standin_pipeline(n=300, k=200), standin_pipeline(n=400, k=200)
+    data, _ = labeled_data(n=300)
+    remote, local = tempfile.mkdtemp(), tempfile.mkdtemp()
+    s3_client, local_path = config.s3_client, serapis.registry.local_path
+    try:
+        config._AttrDict__data['s3_client'] = LocalS3(remote)
+        serapis.registry.local_path = local
+        registry = PipelineRegistry(check_interval=0)
+        registry.register(registry.PRIMARY, key="pipeline.zip")
+
+        first.pack(os.path.join(remote, "pipeline.zip"))
+        loaded = registry.get()
+        assert np.allclose(loaded.predict_proba(data), first.predict_proba(data))
+        assert registry.get() is loaded  # Same version, nothing is reloaded
+
+        # A new version on S3 is downloaded and swapped in
+        second.pack(os.path.join(remote, "pipeline.zip"))
+        mtime = os.path.getmtime(os.path.join(remote, "pipeline.zip")) + 10
+        os.utime(os.path.join(remote, "pipeline.zip"), (mtime, mtime))
+        reloaded = registry.get()
+        assert reloaded is not loaded
+        assert registry.version() == str(mtime)
+        assert np.allclose(reloaded.predict_proba(data), second.predict_proba(data))
+
+        # If a new version can't be downloaded, the loaded pipeline stays in use
+        mtime += 10
+        os.utime(os.path.join(remote, "pipeline.zip"), (mtime, mtime))
+        config._AttrDict__data['s3_client'] = FailingDownloadS3(remote)
+        assert registry.get() is reloaded
+        assert registry.version() == str(mtime - 10)
+
+        # Without S3, the pipeline that was downloaded last stays in use
+        config._AttrDict__data['s3_client'] = UnavailableS3()
+        assert registry.get() is reloaded
+        os.remove(os.path.join(local, "pipeline.zip"))
+        assert registry.get() is reloaded
+
+        # Unless there is nothing to fall back to
+        registry.register("missing", key="missing.zip")
+        with pytest.raises(Exception):
+            registry.get("missing")
+    finally:
+        config._AttrDict__data['s3_client'] = s3_client
+        serapis.registry.local_path = local_path
+        shutil.rmtree(remote)
+        shutil.rmtree(local)
+
+
+def test_shadow_models():
+    import copy
+    from sklearn.naive_bayes import MultinomialNB
+    from serapis.persist_model import PackagedPipeline
+    from serapis.tasks import score_sentences
+
+    primary = standin_pipeline(n=400, k=200)
+    data, labels = labeled_data(n=400)
+    # The shadow shares the s_clean block with the primary model but has its own pos block
+    feature_union = copy.deepcopy(primary._feature_union)
+    dict(feature_union.transformer_list)['pos'].set_params(tfidf__ngram_range=(1, 1)).fit(data, labels)
+    model = MultinomialNB(alpha=1.0).fit(feature_union.transform(data), labels)
+    shadow = PackagedPipeline(pipeline=model, feature_union=feature_union, metadata={'created_at': 'shadow'})
+    fingerprints = [[fingerprint for fingerprint, _, _ in p.block_fingerprints()] for p in (primary, shadow)]
+    assert fingerprints[0][0] == fingerprints[1][0]
+    assert fingerprints[0][1] != fingerprints[1][1]
+
+    # The shared block is only transformed once
+    calls = []
+    for pipeline in (primary, shadow):
+        selector = pipeline.block_fingerprints()[0][1].named_steps['selector']
+        selector.transform = lambda x, transform=selector.transform: calls.append(1) or transform(x)
+    cache = {}
+    expected = [p.predict_proba(data) for p in (primary, shadow)]
+    assert len(calls) == 2
+    assert np.allclose(primary.predict_proba(data, cache), expected[0])
+    assert np.allclose(shadow.predict_proba(data, cache), expected[1])
+    assert len(calls) == 3 and len(cache) == 3
+
+    # Shadow models only add their likelihoods to each sentence
+    sentences = [{'s_clean': s, 'pos_tags': " ".join("x/" + tag for tag in pos.split())}
+                 for s, pos in zip(data['s_clean'][:20], data['pos'])]
+    score_sentences([('primary', primary)], sentences)
+    assert not any('model_likelihoods' in sentence for sentence in sentences)
+    frds = [(sentence['frd'], sentence['frd_likelihood']) for sentence in sentences]
+    score_sentences([('primary', primary), ('shadow', shadow)], sentences)
+    assert [(sentence['frd'], sentence['frd_likelihood']) for sentence in sentences] == frds
+    class_idx = list(shadow.classes_).index(1)
+    for sentence, proba in zip(sentences, expected[1][:20, class_idx]):
+        assert sentence['model_likelihoods'] == {'primary': sentence['frd_likelihood'], 'shadow': round(proba, 4)}
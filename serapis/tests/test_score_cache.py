@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-12"
+__email__ = "manuel@summer.ai"
+
+import os
+import shutil
+import tempfile
+from serapis.score_cache import ScoreCache
+
+
+def test_score_cache():
+    cache = ScoreCache(2)
+    a, b, c = [ScoreCache.key(s, "DT NN", "v1") for s in ("a _TERM_", "b _TERM_", "c _TERM_")]
+    assert a != ScoreCache.key("a _TERM_", "DT NN", "v2")  # Model version is part of the key
+    cache.put(a, [0.1, 0.9])
+    cache.put(b, [0.2, 0.8])
+    assert cache.get(a) == (0.1, 0.9)  # a is now the most recently used
+    cache.put(c, [0.3, 0.7])
+    assert cache.get(b) is None  # Evicted
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'size': 2}
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "scores.pkl")
+        cache.save(filename)
+        restored = ScoreCache(2, filename)
+        assert restored.get(a) == (0.1, 0.9) and restored.get(c) == (0.3, 0.7)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_detect_model_version():
+    import copy
+    import serapis.registry
+    import serapis.tasks
+    from serapis.config import config
+    from serapis.registry import PipelineRegistry
+    from serapis.tasks import detect, score_sentences
+    from serapis.benchmark import labeled_data, standin_pipeline
+    from serapis.tests.test_persist_model import LocalS3
+
+    first = standin_pipeline(n=300, k=200, created_at='test')
+    second = standin_pipeline(n=400, k=200, created_at='retrained')
+    data, _ = labeled_data(n=300)
+    message = {'hashslug': 'test-score-cache', 'urls': [{
+        'doc': " ".join(data['s_clean'][:20]),
+        'sentences': [{'s': s_clean, 's_clean': s_clean} for s_clean in data['s_clean'][:20]]
+    }]}
+
+    def run_detect(pipeline):
+        """Returns the likelihoods detect scored, and those pipeline gives without a cache."""
+        sentences = detect(copy.deepcopy(message))['urls'][0]['sentences']
+        uncached = [{'s_clean': s['s_clean'], 'pos_tags': s['pos_tags']} for s in sentences]
+        score_sentences([('primary', pipeline)], uncached)
+        return [s['frd_likelihood'] for s in sentences], [s['frd_likelihood'] for s in uncached]
+
+    remote, local = tempfile.mkdtemp(), tempfile.mkdtemp()
+    saved = config.s3_client, config.save_messages, config.local_s3
+    registry, local_path, score_cache = serapis.tasks.registry, serapis.registry.local_path, serapis.tasks.score_cache
+    try:
+        config._AttrDict__data.update(s3_client=LocalS3(remote), save_messages=False, local_s3=local)
+        serapis.registry.local_path = local
+        serapis.tasks.registry = PipelineRegistry(check_interval=0)
+        serapis.tasks.registry.register(serapis.tasks.registry.PRIMARY, key="pipeline.zip")
+        cache = serapis.tasks.score_cache = ScoreCache(1000)
+        first.pack(os.path.join(remote, "pipeline.zip"))
+
+        scored, expected = run_detect(first)
+        assert scored == expected
+        assert cache.stats()['misses'] == 20 and cache.stats()['hits'] == 0
+        assert run_detect(first)[0] == scored
+        assert cache.stats()['misses'] == 20 and cache.stats()['hits'] == 20
+
+        # A new model on S3 has a new version, so none of the cached scores are used
+        second.pack(os.path.join(remote, "pipeline.zip"))
+        mtime = os.path.getmtime(os.path.join(remote, "pipeline.zip")) + 10
+        os.utime(os.path.join(remote, "pipeline.zip"), (mtime, mtime))
+        rescored, expected = run_detect(second)
+        assert rescored == expected and rescored != scored
+        assert cache.stats()['misses'] == 40 and cache.stats()['hits'] == 20
+    finally:
+        config._AttrDict__data.update(zip(('s3_client', 'save_messages', 'local_s3'), saved))
+        serapis.registry.local_path = local_path
+        serapis.tasks.registry, serapis.tasks.score_cache = registry, score_cache
+        shutil.rmtree(remote)
+        shutil.rmtree(local)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-10"
+__email__ = "manuel@summer.ai"
+
+import os
+import tempfile
+
+
+def test_scorer_parity():
+    import numpy as np
+    from serapis.benchmark import labeled_data, standin_pipeline
+    from serapis.scorer import LinearScorer
+
+    pipeline = standin_pipeline(n=2000, pos_tfidf={'ngram_range': (1, 2), 'sublinear_tf': True, 'stop_words': 'english'},
+                                pos_weight=0.5, created_at='test')
+    data, _ = labeled_data(n=2000)
+
+    filename = os.path.join(tempfile.mkdtemp(), "model.npz")
+    scorer = LinearScorer.load(pipeline.export_scorer(filename))
+    os.remove(filename)
+
+    assert list(scorer.classes_) == list(pipeline.classes_)
+    assert scorer.metadata['created_at'] == 'test'
+    assert np.allclose(scorer.predict_proba(data), pipeline.predict_proba(data))
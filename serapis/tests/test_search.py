@@ -41,6 +41,17 @@ def test_english_detection():
             assert not detected_english, "Falsely classified '{}...' as English".format(sentence[:40])
 
 
+def test_english_tokens():
+    from nltk import word_tokenize
+    from serapis.language import TOKEN_RE, is_english
+    sentence = "'He's gonna say: \"I don't know\" (at 8:00pm, http://example.com/a-b) about 55,000.5 'things'… it’s odd."
+    # word_tokenize writes double quotes as `` and ''
+    assert TOKEN_RE.findall(sentence.lower()) == [{"``": '"', "''": '"'}.get(t, t.lower()) for t in word_tokenize(sentence)]
+    assert not is_english("")
+    assert is_english("the " + "word " * 9)  # Exactly 10%
+    assert not is_english("the " + "word " * 10)
+
+
 def test_duckduckgo():
     from serapis.search import search_duckduckgo
     result = search_duckduckgo("egregore")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Collection of tests.
+
+Tests methods need to start with "test_", otherwise you're free to do
+whatever you want here.
+"""
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+__author__ = "Manuel Ebert"
+__copyright__ = "Copyright 2016, summer.ai"
+__date__ = "2016-02-11"
+__email__ = "manuel@summer.ai"
+
+import numpy as np
+import pytest
+
+
+def labeled_fixture(n=300):
+    from serapis.benchmark import labeled_data
+    x, y = labeled_data(n=n)
+    return x['s_clean'], np.array(y)
+
+
+def test_search():
+    from sklearn.base import clone
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.feature_selection import SelectKBest
+    from sklearn.metrics import roc_auc_score
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import Pipeline, FeatureUnion
+    from serapis.learning_utils import ItemSelector
+    from serapis.sklearn_model import search, stratified_folds
+
+    sentences, y = labeled_fixture()
+    x = {'x': sentences}
+    feature_union = FeatureUnion(transformer_list=[
+        ('x', Pipeline([
+            ('selector', ItemSelector(key='x')),
+            ('tfidf', TfidfVectorizer()),
+            ('best', SelectKBest(k=100))
+        ]))
+    ])
+    param_grid = {'union__x__best__k': [10, 100, 'all'], 'union__x__tfidf__ngram_range': [(1, 1), (1, 2)],
+                  'mnb__alpha': [0.1, 1.0]}
+    best, results = search(feature_union, MultinomialNB(), x, y, param_grid=param_grid, n_folds=3, n_jobs=2)
+    assert len(results) == 12
+    assert best == max(results, key=lambda result: result['mean_score'])['params']
+
+    # Same scores as fitting each candidate from scratch
+    folds = stratified_folds(y, 3)
+    for result in results:
+        scores = []
+        for train, test in folds:
+            pipeline = Pipeline([('union', clone(feature_union)), ('mnb', MultinomialNB())]).set_params(**result['params'])
+            pipeline.fit({'x': [sentences[i] for i in train]}, y[train])
+            scores.append(roc_auc_score(y[test], pipeline.predict_proba({'x': [sentences[i] for i in test]})[:, -1]))
+        assert np.allclose(result['scores'], scores), result['params']
+
+
+def test_search_small_vocabulary():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.feature_selection import SelectKBest
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import Pipeline, FeatureUnion
+    from serapis.learning_utils import ItemSelector
+    from serapis.sklearn_model import PARAM_GRID, fit_feature_union, search
+
+    words = "alpha beta gamma delta epsilon zeta eta theta iota kappa".split()
+    rng = np.random.RandomState(0)
+    sentences = [" ".join(rng.choice(words, 5)) for _ in range(60)]
+    y = np.array([int("alpha" in sentence) for sentence in sentences])
+    feature_union = FeatureUnion(transformer_list=[
+        ('x', Pipeline([
+            ('selector', ItemSelector(key='x')),
+            ('tfidf', TfidfVectorizer()),
+            ('best', SelectKBest(k=1000))
+        ]))
+    ])
+    # The default grid asks for far more features than the 10 words there are
+    best, results = search(feature_union, MultinomialNB(), {'x': sentences}, y, param_grid=PARAM_GRID, n_jobs=1)
+    scores = {(r['params']['union__x__best__k'], r['params']['mnb__alpha']): r['scores'] for r in results}
+    for alpha in PARAM_GRID['mnb__alpha']:
+        assert scores[(100, alpha)] == scores[(1000, alpha)] == scores[(10000, alpha)]
+
+    feature_union.set_params(x__best__k=best['union__x__best__k'])
+    assert fit_feature_union(feature_union, {'x': sentences}, y).transform({'x': sentences}).shape[0] == 60
+    assert feature_union.get_params()['x__best__k'] in (1, 'all')
+
+
+def test_top_k():
+    from sklearn.feature_selection import SelectKBest
+    from serapis.sklearn_model import _top_k
+    scores = np.array([0.5, np.nan, 0.5, 2.0, 0.1])
+    X, y = np.eye(5), np.arange(5)
+    for k in (1, 2, 3, 5, 'all'):
+        selection = SelectKBest(lambda X, y: (scores, scores), k=k).fit(X, y)
+        assert list(_top_k(scores, k)) == list(selection.get_support())
+    for k in (0, 6):
+        with pytest.raises(ValueError):
+            _top_k(scores, k)
+
+
+def test_streaming_pipeline():
+    import os
+    import shutil
+    import tempfile
+    import unicodecsv as csv
+    from serapis.benchmark import labeled_data
+    from serapis.persist_model import PackagedPipeline
+    from serapis.sklearn_model import build_streaming_pipeline
+
+    data, y = labeled_data(n=300)
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "training.csv")
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f, encoding='utf-8')
+            writer.writerow(['s_clean', 'pos', 'label'])
+            for s_clean, pos, label in zip(data['s_clean'], data['pos'], y):
+                writer.writerow([s_clean, pos, label])
+
+        pipeline = build_streaming_pipeline(filename, chunksize=40, n_features=2 ** 12, test_fraction=0.2,
+                                            max_test_size=50, save=False)
+        assert pipeline.metadata['n_train'] + pipeline.metadata['n_test'] == len(y)
+        assert pipeline.metadata['n_test'] == 50
+        assert pipeline.metadata['auc'] > 0.5
+
+        loaded = PackagedPipeline.from_file(pipeline.pack(os.path.join(directory, "pipeline.zip")))
+        assert np.allclose(loaded.predict_proba(data), pipeline.predict_proba(data))
+    finally:
+        shutil.rmtree(directory)